@@ -11,41 +11,116 @@ import textwrap
 import ctypes
 import logging
 import contextlib
-
-import tkinter
-import requests
-import PIL.Image
-import PIL.ImageEnhance
-import PIL.ImageFilter
+import time
+import re
+import shutil
+import hashlib
+import queue
+import threading
+import functools
+import contextvars
+import concurrent.futures
+import urllib.parse
+import xml.etree.ElementTree
+import cProfile
+import random
+import math
+import sqlite3
+
+# asyncio, email.utils, tkinter, requests and PIL take longer to import
+# than most subcommands take to run, so they're imported by the
+# functions that use them.
 
 SCRIPT_PATH = os.path.realpath(__file__)
-ROOT_DIR = os.path.dirname(SCRIPT_PATH)
+# Where the data, images and log are kept.
+ROOT_DIR = os.environ.get("XD_ROOT") or os.path.dirname(SCRIPT_PATH)
 LOG_PATH = os.path.join(ROOT_DIR, "log")
-
-LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
-_DEBUG_HANDLER = logging.FileHandler(LOG_PATH, mode="w")
-_DEBUG_HANDLER.setLevel(logging.DEBUG)
-_DEBUG_FORMATTER = logging.Formatter(
-    "{name}:{levelname}: {message}", style="{"
+# Number of posts fetched per request to fill the candidate pool.
+POOL_SIZE = 100
+# File extensions of posts that can be edited into wallpapers.
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp")
+# Fields of the link, width and height of each rendition of a post's
+# image, smallest first.
+IMAGE_VARIANTS = {
+    "preview": ("preview_file_url", "preview_width", "preview_height"),
+    "sample": ("large_file_url", "sample_width", "sample_height"),
+    "jpeg": ("jpeg_url", "jpeg_width", "jpeg_height"),
+    "original": ("file_url", "image_width", "image_height"),
+}
+# Number of connections kept alive per host.
+HTTP_POOL_SIZE = 4
+# Requests per second allowed to each host, and how many can be saved up.
+RATE_LIMIT = 2.0
+RATE_BURST = 5
+# Seconds to wait for a connection and then for data from a server.
+REQUEST_TIMEOUT = (10, 60)
+# Times a failed request is retried, and the most seconds between tries.
+RETRIES = 4
+MAX_BACKOFF = 60
+# Statuses that mean a request may succeed if tried again later.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Bytes buffered per write to disk when downloading.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Bytes read from the network at a time when downloading. A read cut
+# short by a dropped connection is lost, so it's kept small.
+DOWNLOAD_READ_SIZE = 64 * 1024
+# Seconds between download progress updates.
+PROGRESS_INTERVAL = 0.25
+# Seconds before the post counts of tags are looked up again.
+TAG_COUNT_AGE = 7 * 24 * 60 * 60
+# Seconds before detected screen dimensions are looked up again.
+SCREEN_CACHE_AGE = 60 * 60
+# Most wallpapers the daemon prepares ahead of time.
+PREFETCH_LIMIT = 4
+# Seconds the daemon waits after failing to prepare a wallpaper.
+RETRY_DELAY = 60
+# Options that change which wallpaper is prepared and how it looks.
+PREPARE_OPTIONS = (
+    "tags", "blacklist", "imageboard", "scale", "resolution", "oversample",
+    "blur", "grey", "dim",
+)
+# Weights of the red, green and blue channels in a greyscale image.
+LUMA = (0.299, 0.587, 0.114)
+# Quality of edited JPEGs.
+EDIT_QUALITY = 90
+# Bytes the log can grow to before it's rotated.
+LOG_SIZE = 1024 * 1024
+# Bytes the event log can grow to before it's rotated, and how many old
+# event logs are kept.
+EVENT_LOG_SIZE = 1024 * 1024
+EVENT_LOG_BACKUPS = 3
+# Events too frequent to record every time, and 1 in how many are kept.
+EVENT_SAMPLING = {"response": 5, "wait": 10}
+
+# Desktop environments set_linux_wallpaper knows, other than using feh.
+LINUX_DESKTOPS = (
+    "gnome", "x-cinnamon", "unity", "pantheon", "budgie:gnome", "mate", "kde",
+    "xfce", "enlightenment",
 )
-_DEBUG_HANDLER.setFormatter(_DEBUG_FORMATTER)
-_TERMINAL_HANDLER = logging.StreamHandler()
-_TERMINAL_HANDLER.setLevel(logging.INFO)
-_TERMINAL_FORMATTER = logging.Formatter("{levelname}: {message}", style="{")
-_TERMINAL_HANDLER.setFormatter(_TERMINAL_FORMATTER)
-LOGGER.addHandler(_DEBUG_HANDLER)
-LOGGER.addHandler(_TERMINAL_HANDLER)
 
+# Subcommands that change the wallpaper or settings, whose runs are
+# written to the log. The others leave the last run's log alone.
+LOGGED_SUBCOMMANDS = ("set", "reset", "next", "daemon", "reedit")
 
-def sorted_files(directory):
-    """Return a list of files sorted by modified date."""
-    files = []
-    for file in os.listdir(directory):
-        path = os.path.join(directory, file)
-        files.append(path)
-    files.sort(key=os.path.getmtime)
-    return files
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+_DEBUG_HANDLER = None
+_TERMINAL_HANDLER = None
+# Structured records of what happened, for later analysis.
+EVENTS = logging.getLogger(f"{__name__}.events")
+EVENTS.propagate = False
+_EVENT_HANDLER = None
+
+_SESSION = None
+_RATE_LIMITER = None
+# Runs blocking network, disk and image work for the asyncio pipeline.
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor()
+# Renders images on every core, started when first needed.
+_PROCESS_POOL = None
+# StateStore of each data directory.
+_STATE_STORES = {}
+# Deadline of the requests made in the current context, if any.
+_DEADLINE = contextvars.ContextVar("_DEADLINE", default=None)
 
 
 def makedirs(directories):
@@ -54,6 +129,137 @@ def makedirs(directories):
         os.makedirs(directory, exist_ok=True)
 
 
+def init_logging(verbose=False, log_file=True):
+    """Send log messages to the terminal, and to the log file if asked.
+
+    Handlers are only added the first time, so this can be called again
+    to change the verbosity.
+
+    Args:
+        verbose (bool): Whether to display debug messages in the
+            terminal. Defaults to False.
+        log_file (bool): Whether to write debug messages to the log.
+            The last run's log is moved to log.1. Defaults to True.
+    """
+    import logging.handlers
+    global _DEBUG_HANDLER, _TERMINAL_HANDLER
+    if _TERMINAL_HANDLER is None:
+        _TERMINAL_HANDLER = logging.StreamHandler()
+        _TERMINAL_HANDLER.setFormatter(
+            logging.Formatter("{levelname}: {message}", style="{")
+        )
+        LOGGER.addHandler(_TERMINAL_HANDLER)
+    _TERMINAL_HANDLER.setLevel(logging.DEBUG if verbose else logging.INFO)
+    if log_file and _DEBUG_HANDLER is None:
+        # Rotated as it grows too, so the daemon's log stays bounded.
+        _DEBUG_HANDLER = logging.handlers.RotatingFileHandler(
+            LOG_PATH, maxBytes=LOG_SIZE, backupCount=1, delay=True
+        )
+        _DEBUG_HANDLER.doRollover()
+        _DEBUG_HANDLER.setLevel(logging.DEBUG)
+        _DEBUG_HANDLER.setFormatter(
+            logging.Formatter("{name}:{levelname}: {message}", style="{")
+        )
+        LOGGER.addHandler(_DEBUG_HANDLER)
+
+
+class EventFormatter(logging.Formatter):
+
+    """Formatter that writes an event and its fields as a line of JSON."""
+
+    def format(self, record):
+        event = {"time": record.created, "event": record.msg}
+        event.update(record.fields)
+        return json.dumps(event)
+
+
+class EventSampler(logging.Filter):
+
+    """Filter that keeps 1 in every few of the events that are frequent.
+
+    Events are kept at random rather than counted, as a run of the next
+    subcommand may only see one. Kept events are given a "sample" field
+    saying how many they stand for, so totals can still be estimated.
+    """
+
+    def __init__(self, sampling):
+        super().__init__()
+        self.sampling = sampling
+
+    def filter(self, record):
+        rate = self.sampling.get(record.msg, 1)
+        if rate == 1:
+            return True
+        record.fields["sample"] = rate
+        return random.random() < 1 / rate
+
+
+def init_event_log(path, sampling=None):
+    """Start recording events to a file of JSON lines.
+
+    The file is rotated once it reaches EVENT_LOG_SIZE bytes, keeping
+    EVENT_LOG_BACKUPS old ones.
+
+    Args:
+        path (str): Location of the event log.
+        sampling (dict): 1 in how many of each event to record, by
+            name. Defaults to EVENT_SAMPLING.
+    """
+    import logging.handlers
+    global _EVENT_HANDLER
+    if _EVENT_HANDLER is not None:
+        EVENTS.removeHandler(_EVENT_HANDLER)
+        _EVENT_HANDLER.close()
+    if sampling is None:
+        sampling = EVENT_SAMPLING
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=EVENT_LOG_SIZE, backupCount=EVENT_LOG_BACKUPS,
+        encoding="utf-8", delay=True
+    )
+    handler.setFormatter(EventFormatter())
+    handler.addFilter(EventSampler(sampling))
+    EVENTS.addHandler(handler)
+    _EVENT_HANDLER = handler
+
+
+def log_event(name, **fields):
+    """Record an event with JSON-serialisable fields, if events are kept.
+
+    Nothing is formatted unless the event is written, so events are
+    cheap to log when the event log is off or they're sampled out.
+    """
+    if _EVENT_HANDLER is not None:
+        EVENTS.info(name, extra={"fields": fields})
+
+
+def read_events(path, name=None):
+    """Return the recorded events, oldest first, including rotated ones.
+
+    Args:
+        path (str): Location of the event log.
+        name (str): Only return events with this name. Defaults to None,
+            meaning all events are returned.
+    """
+    paths = [f"{path}.{number}" for number in range(EVENT_LOG_BACKUPS, 0, -1)]
+    paths.append(path)
+    events = []
+    for log_path in paths:
+        try:
+            file = open(log_path, encoding="utf-8")
+        except FileNotFoundError:
+            continue
+        with file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # Cut off by a crash.
+                    continue
+                if name is None or event["event"] == name:
+                    events.append(event)
+    return events
+
+
 def wait_warmly():
     """Yield parts of a spinning cursor."""
     chars = r"-\|/"
@@ -69,14 +275,206 @@ def spinner():
     print("\bDone.")
 
 
-def screen_dimensions():
-    """Return a tuple of the screen height and width."""
-    root = tkinter.Tk()
-    height = root.winfo_screenheight()
-    width = root.winfo_screenwidth()
-    dimensions = (height, width)
-    LOGGER.debug(f"screen dimensions = {height}x{width}")
-    return dimensions
+@contextlib.contextmanager
+def timed(timings, stage):
+    """Context manager that records how many seconds a stage took."""
+    start = time.perf_counter()
+    yield
+    if timings is not None:
+        timings[stage] = time.perf_counter() - start
+
+
+def call_timed(timings, stage, function, *args, **kwargs):
+    """Call a function, recording how many seconds it took."""
+    with timed(timings, stage):
+        return function(*args, **kwargs)
+
+
+def align_monitors(monitors):
+    """Return monitors moved so the layout starts at the top left."""
+    top = min(monitor[2] for monitor in monitors)
+    left = min(monitor[3] for monitor in monitors)
+    return [
+        (height, width, monitor_top - top, monitor_left - left)
+        for (height, width, monitor_top, monitor_left) in monitors
+    ]
+
+
+def layout_size(monitors):
+    """Return the height and width of the area a layout of monitors spans."""
+    height = max(top + height for (height, _, top, _) in monitors)
+    width = max(left + width for (_, width, _, left) in monitors)
+    return (height, width)
+
+
+def parse_monitors(text):
+    """Return the monitors in a WIDTHxHEIGHT[+X+Y][,...] string.
+
+    Returns:
+        [(int, int, int, int)]: The height, width, top and left of each
+            monitor, in pixels.
+
+    Raises:
+        ValueError: If the string isn't of that form.
+    """
+    monitors = []
+    for geometry in text.split(","):
+        match = re.fullmatch(
+            r"\s*(\d+)\s*x\s*(\d+)\s*(?:\+(\d+)\+(\d+))?\s*", geometry
+        )
+        if match is None:
+            raise ValueError(
+                f"{text!r} is not of the form WIDTHxHEIGHT[+X+Y][,...]."
+            )
+        (width, height, left, top) = match.groups()
+        monitors.append(
+            (int(height), int(width), int(top or 0), int(left or 0))
+        )
+    return align_monitors(monitors)
+
+
+def parse_resolution(text):
+    """Return the height and width spanned by a WIDTHxHEIGHT string.
+
+    Several monitors can be given too, as with parse_monitors.
+    """
+    return layout_size(parse_monitors(text))
+
+
+def format_monitors(monitors):
+    """Return the WIDTHxHEIGHT[+X+Y][,...] string of some monitors."""
+    if len(monitors) == 1:
+        (height, width, _, _) = monitors[0]
+        return f"{width}x{height}"
+    return ",".join(
+        f"{width}x{height}+{left}+{top}"
+        for (height, width, top, left) in monitors
+    )
+
+
+def xrandr_monitors():
+    """Return the monitors according to xrandr, if any.
+
+    They are in the order Xinerama numbers them, which is the order feh
+    gives them wallpapers in.
+    """
+    xrandr = os.environ.get("XRANDR") or shutil.which("xrandr")
+    if xrandr is None or not os.environ.get("DISPLAY"):
+        return None
+    try:
+        output = subprocess.run(
+            [xrandr, "--listmonitors"], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True, timeout=5
+        ).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    # Lines look like " 0: +*DP-1 1920/527x1080/296+0+0  DP-1".
+    matches = re.findall(
+        r"^\s*\d+: \S+ (\d+)/\d+x(\d+)/\d+\+(\d+)\+(\d+)", output,
+        flags=re.MULTILINE
+    )
+    if not matches:
+        return None
+    return align_monitors([
+        (int(height), int(width), int(top), int(left))
+        for (width, height, left, top) in matches
+    ])
+
+
+def windows_dimensions():
+    """Return the screen height and width on Windows, if possible."""
+    if sys.platform != "win32":
+        return None
+    sm_cxscreen = 0
+    sm_cyscreen = 1
+    user32 = ctypes.windll.user32
+    return (user32.GetSystemMetrics(sm_cyscreen),
+            user32.GetSystemMetrics(sm_cxscreen))
+
+
+def tkinter_dimensions():
+    """Return the screen height and width according to Tk."""
+    import tkinter
+    try:
+        root = tkinter.Tk()
+    except tkinter.TclError:
+        print(textwrap.fill(
+            "Could not detect the screen size. Please set it with "
+            "`set --resolution WIDTHxHEIGHT`."
+        ))
+        sys.exit(2)
+    try:
+        return (root.winfo_screenheight(), root.winfo_screenwidth())
+    finally:
+        root.destroy()
+
+
+def display_name():
+    """Return an identifier for the display the program is run on."""
+    return os.environ.get("WAYLAND_DISPLAY") or os.environ.get("DISPLAY", "")
+
+
+def read_screen_cache(cache_path):
+    """Return cached monitor geometries if they are still valid."""
+    try:
+        cache = read_json(cache_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    fresh = (
+        cache.get("display") == display_name() and
+        time.time() - cache.get("time", 0) < SCREEN_CACHE_AGE
+    )
+    if not fresh or "monitors" not in cache:
+        return None
+    return [tuple(monitor) for monitor in cache["monitors"]]
+
+
+def monitor_geometries(resolution="", cache_path=None):
+    """Return the geometry of every monitor.
+
+    Cheap sources are tried first, and Tk is only started if nothing
+    else knows the answer. Only xrandr can tell monitors apart, so
+    elsewhere the screen is treated as one monitor. Detected geometries
+    are cached for SCREEN_CACHE_AGE seconds, or until the display
+    changes.
+
+    Args:
+        resolution (str): WIDTHxHEIGHT[+X+Y][,...] to use instead of
+            detecting the monitors. Defaults to "", meaning detect them.
+        cache_path (str): Location of the cached geometries. Defaults to
+            None, meaning they aren't cached.
+
+    Returns:
+        [(int, int, int, int)]: The height, width, top and left of each
+            monitor, in pixels.
+    """
+    environment = os.environ.get("XD_RESOLUTION", "")
+    if resolution or environment:
+        return parse_monitors(resolution or environment)
+    monitors = None
+    if cache_path is not None:
+        monitors = read_screen_cache(cache_path)
+    if monitors is None:
+        monitors = xrandr_monitors()
+        if monitors is None:
+            (height, width) = windows_dimensions() or tkinter_dimensions()
+            monitors = [(height, width, 0, 0)]
+        if cache_path is not None:
+            write_json(cache_path, {
+                "display": display_name(),
+                "time": time.time(),
+                "monitors": monitors,
+            })
+    LOGGER.debug(f"monitors = {format_monitors(monitors)}")
+    return monitors
+
+
+def screen_dimensions(resolution="", cache_path=None):
+    """Return a tuple of the height and width spanned by the monitors.
+
+    See monitor_geometries for the arguments.
+    """
+    return layout_size(monitor_geometries(resolution, cache_path))
 
 
 def read_json(path):
@@ -86,20 +484,657 @@ def read_json(path):
     return data
 
 
-def write_json(path, data):
-    """Store a dictionary as a JSON file."""
-    with open(path, "w") as file:
-        json.dump(data, file, indent=4)
+def write_temporary(path, text, sync=True):
+    """Write text beside a file, returning its path.
 
+    Args:
+        sync (bool): Whether to wait until it's on disk. Defaults to
+            True.
+    """
+    temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w") as file:
+            file.write(text)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def write_json(path, data, sync=True):
+    """Store a dictionary as a JSON file.
+
+    The file is written whole beside the old one and then renamed over
+    it, so a crash never leaves it half written.
+
+    Args:
+        sync (bool): Whether to wait until the file is on disk before
+            renaming it, so it survives a power cut too. Defaults to
+            True.
+    """
+    temp_path = write_temporary(path, json.dumps(data, indent=4), sync)
+    os.replace(temp_path, path)
+
+
+def replay_journal(journal_path):
+    """Finish the renames of a transaction interrupted by a crash."""
+    try:
+        renames = read_json(journal_path)
+    except FileNotFoundError:
+        return
+    except json.JSONDecodeError:
+        # Journals are written atomically, so this is someone else's.
+        renames = []
+    for (temp_path, path) in renames:
+        if os.path.exists(temp_path):
+            LOGGER.debug(f"replaying write of {path}")
+            os.replace(temp_path, path)
+    os.remove(journal_path)
+
+
+def lock_file(file):
+    """Wait for an exclusive advisory lock on an open file."""
+    if sys.platform == "win32":
+        import msvcrt
+        file.seek(0)
+        # Gives up after 10 seconds with an OSError.
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+
+def unlock_file(file):
+    """Release a lock from lock_file."""
+    if sys.platform == "win32":
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class StateStore:
+
+    """JSON files in a data directory that change together.
+
+    Changes are made under an advisory lock on the directory, so a
+    cron-fired next and an interactive set can't write over each
+    other, and every file changed at once is written in a single
+    transaction: the new files are synced beside the old ones, a
+    journal of the renames is written, and the renames are made. A
+    transaction interrupted by a crash is finished the next time the
+    lock is taken. While coalescing, changes are kept in memory and
+    written together when the coalescing block ends or flush is called.
+    """
+
+    def __init__(self, data_dir):
+        self.lock_path = os.path.join(data_dir, "state.lock")
+        self.journal_path = os.path.join(data_dir, "state.journal")
+        # JSON of the changes not yet written, by path.
+        self.pending = {}
+        self.coalescing = False
+        self.mutex = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the lock on the state for the duration of the block.
+
+        The lock can be taken again by the thread holding it.
+        """
+        with self.mutex:
+            if not self.depth:
+                self.lock_file = open(self.lock_path, "a+")
+                try:
+                    lock_file(self.lock_file)
+                    replay_journal(self.journal_path)
+                except BaseException:
+                    self.lock_file.close()
+                    raise
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if not self.depth:
+                    unlock_file(self.lock_file)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    @contextlib.contextmanager
+    def coalesced(self):
+        """Keep the changes made in the block, and write them at the end."""
+        with self.mutex:
+            (previous, self.coalescing) = (self.coalescing, True)
+        try:
+            yield
+        finally:
+            with self.mutex:
+                self.coalescing = previous
+            if not previous:
+                self.flush()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Make the reads and changes in the block as one transaction."""
+        with self.locked(), self.coalesced():
+            yield
+
+    def read(self, path):
+        """Return a JSON file, including changes not yet written.
+
+        Raises:
+            FileNotFoundError: If the file doesn't exist.
+            json.JSONDecodeError: If the file isn't JSON.
+        """
+        with self.locked():
+            if path in self.pending:
+                return json.loads(self.pending[path])
+            return read_json(path)
+
+    def write(self, path, data):
+        """Change a JSON file, unless coalescing, when it's written later."""
+        with self.mutex:
+            self.pending[path] = json.dumps(data, indent=4)
+            if not self.coalescing:
+                self.flush()
+
+    def flush(self):
+        """Write every change not yet written in one transaction."""
+        with self.locked():
+            if not self.pending:
+                return
+            renames = [
+                (write_temporary(path, text), path)
+                for (path, text) in self.pending.items()
+            ]
+            if len(renames) > 1:
+                write_json(self.journal_path, renames)
+                replay_journal(self.journal_path)
+            else:
+                os.replace(*renames[0])
+            LOGGER.debug(f"wrote {', '.join(self.pending)}")
+            self.pending.clear()
+
+
+def state_store(data_dir):
+    """Return the shared StateStore of a data directory."""
+    if data_dir not in _STATE_STORES:
+        _STATE_STORES[data_dir] = StateStore(data_dir)
+    return _STATE_STORES[data_dir]
+
+
+def init_http_session(pool_size=HTTP_POOL_SIZE):
+    """Create the HTTP session shared by every request and return it.
+
+    Connections are kept alive and pooled per host, so consecutive
+    requests to the same imageboard skip the TCP and TLS handshakes.
+
+    Args:
+        pool_size (int): Number of connections to keep per host.
+            Defaults to HTTP_POOL_SIZE.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    import requests
+    import requests.adapters
+    global _SESSION
+    if _SESSION is not None:
+        _SESSION.close()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    _SESSION = session
+    return session
+
+
+def http_session():
+    """Return the shared HTTP session, creating it if necessary."""
+    if _SESSION is None:
+        return init_http_session()
+    return _SESSION
+
+
+def connection_stats():
+    """Return the number of requests and new connections per host."""
+    stats = {}
+    if _SESSION is None:
+        return stats
+    for adapter in set(_SESSION.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = f"{pool.scheme}://{pool.host}"
+            stats[host] = {
+                "requests": pool.num_requests,
+                "connections": pool.num_connections,
+                "reused": pool.num_requests - pool.num_connections,
+            }
+    return stats
+
+
+def connections_since(since=None):
+    """Return the requests and new connections made since a snapshot.
+
+    Args:
+        since (dict): Earlier result of connection_stats. Defaults to
+            None, meaning since the session was created.
+
+    Returns:
+        (int, int): The number of requests and of new connections.
+    """
+    since = since or {}
+    (requests, connections) = (0, 0)
+    for (host, stats) in connection_stats().items():
+        before = since.get(host, {"requests": 0, "connections": 0})
+        requests += stats["requests"] - before["requests"]
+        connections += stats["connections"] - before["connections"]
+    return (requests, connections)
+
+
+class RateLimiter:
+
+    """Token bucket per host, kept on disk so separate runs share it.
+
+    The buckets are read and written back under an advisory lock, so
+    runs at the same time don't lose each other's requests.
+    """
+
+    def __init__(self, path=None, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the buckets left by other runs, if any."""
+        if self.path is None:
+            return
+        try:
+            self.buckets = read_json(self.path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def save(self):
+        """Write the buckets for other runs."""
+        if self.path is not None:
+            # Losing them to a power cut only costs a little politeness.
+            write_json(self.path, self.buckets, sync=False)
+
+    @contextlib.contextmanager
+    def shared(self):
+        """Hold the latest buckets for the block, and write them after."""
+        with self.lock:
+            if self.path is None:
+                yield
+                return
+            with open(f"{self.path}.lock", "a+") as file:
+                lock_file(file)
+                try:
+                    self.load()
+                    yield
+                    self.save()
+                finally:
+                    unlock_file(file)
+
+    def bucket(self, host, now):
+        """Return the bucket of a host, refilled up to now."""
+        bucket = self.buckets.setdefault(host, {
+            "tokens": self.burst, "time": now, "blocked_until": 0,
+        })
+        if self.rate:
+            refill = (now - bucket["time"]) * self.rate
+            bucket["tokens"] = min(self.burst, bucket["tokens"] + refill)
+        bucket["time"] = now
+        # Blocks from before they were capped may be longer.
+        bucket["blocked_until"] = min(
+            bucket["blocked_until"], now + MAX_BACKOFF
+        )
+        return bucket
+
+    def acquire(self, host, deadline=None):
+        """Wait until a request to a host is allowed.
+
+        Args:
+            host (str): Host the request is to.
+            deadline (Deadline): Deadline the wait mustn't pass. Defaults
+                to None.
+
+        Raises:
+            requests.Timeout: If the wait would pass `deadline`, or it
+                was cancelled.
+        """
+        with self.shared():
+            now = time.time()
+            bucket = self.bucket(host, now)
+            wait = max(0, bucket["blocked_until"] - now)
+            if self.rate:
+                # Tokens can go negative, reserving a later slot.
+                bucket["tokens"] -= 1
+                if bucket["tokens"] < 0:
+                    wait = max(wait, -bucket["tokens"] / self.rate)
+        if wait:
+            LOGGER.debug(f"waiting {wait:.1f}s for {host}")
+            log_event("wait", host=host, seconds=wait)
+            if deadline is None:
+                time.sleep(wait)
+                return
+            left = deadline.remaining()
+            if left is not None and wait > left:
+                import requests
+                raise requests.Timeout(f"{host} is blocked for {wait:.0f}s.")
+            deadline.sleep(wait)
+
+    def block(self, host, seconds):
+        """Stop requests to a host for a while, at most MAX_BACKOFF."""
+        with self.shared():
+            now = time.time()
+            bucket = self.bucket(host, now)
+            bucket["blocked_until"] = max(
+                bucket["blocked_until"], now + min(seconds, MAX_BACKOFF)
+            )
+
+
+def init_rate_limiter(path=None, rate=RATE_LIMIT):
+    """Create the rate limiter shared by every request and return it.
+
+    Args:
+        path (str): Location to keep the limits between runs. Defaults
+            to None, meaning they are only kept in memory.
+        rate (float): Requests per second allowed to each host, with 0
+            meaning no limit. Defaults to RATE_LIMIT.
+    """
+    global _RATE_LIMITER
+    _RATE_LIMITER = RateLimiter(path, rate)
+    return _RATE_LIMITER
 
-def download(url, path):
-    """Store a copy of a file from the internet."""
-    with requests.get(url, stream=True) as response, open(path, "wb") as file,\
-            spinner() as cursors:
-        chunks = response.iter_content(chunk_size=128)
-        for cursor, chunk in zip(cursors, chunks):
-            print("\rDownloading...", cursor, end="")
-            file.write(chunk)
+
+def rate_limiter():
+    """Return the shared rate limiter, creating it if necessary."""
+    if _RATE_LIMITER is None:
+        return init_rate_limiter()
+    return _RATE_LIMITER
+
+
+def retry_after(response):
+    """Return the seconds a response asks to wait before retrying."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - time.time())
+
+
+def backoff(attempt):
+    """Return a random delay that grows exponentially with attempts."""
+    cap = min(MAX_BACKOFF, 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+class Deadline:
+
+    """Time by which the requests made for a stage must be done.
+
+    Requests still running once the stage is over are given up on
+    between tries, and never wait on the network past the deadline, so
+    they can't keep the program from exiting for long.
+    """
+
+    def __init__(self, seconds=0):
+        """Start the clock.
+
+        Args:
+            seconds (float): Seconds the requests have. Defaults to 0,
+                meaning they can take as long as they need until the
+                deadline is cancelled.
+        """
+        self.end = time.monotonic() + seconds if seconds else None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Give up on the requests still running."""
+        self.cancelled.set()
+
+    def remaining(self):
+        """Return the seconds left, or None if there's no limit.
+
+        Raises:
+            requests.Timeout: If the deadline has passed or was
+                cancelled.
+        """
+        import requests
+        if self.cancelled.is_set():
+            raise requests.Timeout("The request was given up on.")
+        if self.end is None:
+            return None
+        left = self.end - time.monotonic()
+        if left <= 0:
+            raise requests.Timeout("The request ran out of time.")
+        return left
+
+    def timeout(self, timeout):
+        """Return connect and read timeouts cut short by the deadline."""
+        left = self.remaining()
+        if left is None:
+            return timeout
+        return tuple(min(part, left) for part in timeout)
+
+    def sleep(self, seconds):
+        """Wait, unless the deadline passes or is cancelled first."""
+        left = self.remaining()
+        self.cancelled.wait(seconds if left is None else min(seconds, left))
+        self.remaining()
+
+
+def send_request(url, retries=RETRIES, **kwargs):
+    """Make a rate-limited GET request, retrying when it's worth it.
+
+    Requests that fail to connect or are told to try again later are
+    retried after an exponential backoff with jitter, or after as long
+    as the server asks for with Retry-After, unless that's longer than
+    MAX_BACKOFF. Within a Deadline, nothing waits past it.
+
+    Args:
+        url (str): Webpage link to make a request to.
+        retries (int): Times to retry. Defaults to RETRIES.
+        **kwargs: Passed on to requests.Session.get.
+
+    Returns:
+        requests.Response: The last response, whatever its status, or
+            the first asking to wait longer than MAX_BACKOFF.
+
+    Raises:
+        requests.ConnectionError: If no connection could be made.
+        requests.Timeout: If the server took too long to respond, or
+            the deadline passed.
+    """
+    import requests
+    host = urllib.parse.urlsplit(url).netloc
+    limiter = rate_limiter()
+    timeout = kwargs.pop("timeout", REQUEST_TIMEOUT)
+    deadline = _DEADLINE.get()
+    sleep = time.sleep if deadline is None else deadline.sleep
+    for attempt in range(retries + 1):
+        limiter.acquire(host, deadline)
+        kwargs["timeout"] = (
+            timeout if deadline is None else deadline.timeout(timeout)
+        )
+        try:
+            response = http_session().get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            if attempt == retries:
+                raise
+            delay = backoff(attempt)
+            LOGGER.warning(f"{ex}, retrying in {delay:.1f}s")
+            log_event("retry", host=host, error=str(ex), delay=delay)
+            sleep(delay)
+            continue
+        status = response.status_code
+        if status not in RETRY_STATUSES or attempt == retries:
+            return response
+        delay = retry_after(response)
+        if delay is None:
+            delay = backoff(attempt)
+        else:
+            limiter.block(host, delay)
+            if delay > MAX_BACKOFF:
+                LOGGER.warning(f"{url} asked to wait {delay:.0f}s")
+                return response
+        response.close()
+        LOGGER.warning(f"{url} returned {status}, retrying in {delay:.1f}s")
+        log_event("retry", host=host, status=status, delay=delay)
+        sleep(delay)
+    return response
+
+
+def init_network(config, data_dir):
+    """Set up the shared HTTP session and rate limiter from the config."""
+    init_http_session(config["connections"])
+    limits_path = os.path.join(data_dir, "rate_limits.json")
+    init_rate_limiter(limits_path, config["rate"])
+
+
+def format_bytes(num):
+    """Return a human-readable amount of bytes."""
+    for unit in ("B", "KiB", "MiB"):
+        if num < 1024:
+            return f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} GiB"
+
+
+def download_progress(done, total, elapsed):
+    """Return a line describing how far along a download is."""
+    rate = done / elapsed if elapsed else 0
+    progress = f"{format_bytes(done)}"
+    if total:
+        progress += f"/{format_bytes(total)}"
+    progress += f" at {format_bytes(rate)}/s"
+    if total and rate:
+        eta = (total - done) / rate
+        progress += f", {eta:.0f}s left"
+    return progress
+
+
+def request_remainder(url, part_path):
+    """Request what's missing from a partial download.
+
+    Returns:
+        (requests.Response, int): The streamed response, and the offset
+            in the file it starts at, which is 0 if the server sent the
+            whole file.
+
+    Raises:
+        requests.HTTPError: If the file couldn't be downloaded.
+    """
+    try:
+        offset = os.path.getsize(part_path)
+    except FileNotFoundError:
+        offset = 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    response = send_request(url, stream=True, headers=headers)
+    range_not_satisfiable = 416
+    if response.status_code == range_not_satisfiable:
+        # The partial file is stale, so start from scratch.
+        LOGGER.debug(f"discarding {part_path}")
+        response.close()
+        response = send_request(url, stream=True)
+    partial_content = 206
+    if response.status_code != partial_content:
+        offset = 0
+    LOGGER.debug(f"download offset = {offset}")
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    return (response, offset)
+
+
+def download(url, path, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=RETRIES):
+    """Store a copy of a file from the internet.
+
+    The file is written to a temporary path beside `path` and renamed
+    once complete, so an interrupted download never leaves a truncated
+    file behind. If the connection drops, or a previous download was
+    interrupted, only the rest of the file is requested.
+
+    Args:
+        url (str): Link to the file.
+        path (str): Where to store the file.
+        chunk_size (int): Bytes to buffer per write to disk. Defaults to
+            DOWNLOAD_CHUNK_SIZE.
+        retries (int): Times to resume after the connection drops.
+            Defaults to RETRIES.
+
+    Returns:
+        int: Number of bytes downloaded.
+
+    Raises:
+        requests.HTTPError: If the file couldn't be downloaded.
+        requests.RequestException: If the connection dropped more than
+            `retries` times, leaving the partial file to resume later.
+    """
+    import requests
+    part_path = f"{path}.part"
+    received = 0
+    start = time.monotonic()
+    last_update = 0
+    for attempt in range(retries + 1):
+        (response, offset) = request_remainder(url, part_path)
+        if attempt == 0:
+            first_offset = offset
+        # The bytes already received this run count towards the total.
+        length = received + int(response.headers.get("Content-Length", 0))
+        try:
+            with response, open(part_path, "ab" if offset else "wb",
+                                buffering=chunk_size) as file,\
+                    spinner() as cursors:
+                chunks = response.iter_content(chunk_size=DOWNLOAD_READ_SIZE)
+                for chunk in chunks:
+                    file.write(chunk)
+                    received += len(chunk)
+                    now = time.monotonic()
+                    if now - last_update >= PROGRESS_INTERVAL:
+                        last_update = now
+                        progress = download_progress(
+                            received, length, now - start
+                        )
+                        print(
+                            f"\rDownloading... {progress}", next(cursors),
+                            end=""
+                        )
+            break
+        except (requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as ex:
+            if attempt == retries:
+                raise
+            LOGGER.warning(f"{ex}, resuming the download")
+            log_event("retry", url=url, error=str(ex), delay=0)
+    os.replace(part_path, path)
+    log_event(
+        "download", url=url, bytes=received, offset=first_offset,
+        seconds=time.monotonic() - start
+    )
+    return received
 
 
 def get_json(url, params):
@@ -112,114 +1147,1268 @@ def get_json(url, params):
     Returns:
         dict: A JSON object from `url` decoded to a Python dictionary.
 
-    # Raises:
-    #     RequestError: If the request is unsuccessful.
-    #     ValueError: If no JSON data is available from `url`.
+    Raises:
+        requests.RequestException: If the request is unsuccessful, even
+            after retrying.
+        ValueError: If no JSON data is available from `url`.
     """
-    # XXX: Is this needed?
-    # success = range(100, 400)
-    try:
-        response = requests.get(url, params=params)
-    except requests.exceptions.ConnectionError:
-        print("No internet connection. Please connect to the internet.")
-        sys.exit(126)
+    response = send_request(url, params=params)
     status = response.status_code
     LOGGER.debug(f"status = {status}")
-    # succeeded = status in success
-    # if succeeded:
+    response.raise_for_status()
     json_data = response.json()
-    # else:
-        # raise RequestError(f"Response returned code {status}.")
-    # if not json_data:
-        # raise ValueError(f"No data from {url}.")
-    LOGGER.debug(f"json_data = {json_data}")
+    log_event(
+        "response", url=response.url, status=status,
+        bytes=len(response.content),
+        seconds=response.elapsed.total_seconds()
+    )
     return json_data
 
 
-def get_image_data(tags, imageboard, attempts=1, scale=1.0):
+def xml_post(element):
+    """Return a post from an XML element in the shape Danbooru uses."""
+    # Older APIs use attributes, newer ones use child elements.
+    fields = dict(element.attrib)
+    fields.update((child.tag, child.text or "") for child in element)
+    data = {
+        "id": int(fields["id"]),
+        "md5": fields.get("md5") or None,
+        "image_width": int(fields.get("width") or 0),
+        "image_height": int(fields.get("height") or 0),
+        "tag_string": fields.get("tags", "").strip(),
+        "rating": fields.get("rating"),
+        "large_file_url": fields.get("sample_url") or None,
+        "preview_file_url": fields.get("preview_url") or None,
+        # Moebooru keeps a JPEG of PNGs at full size.
+        "jpeg_url": fields.get("jpeg_url") or None,
+        # Not distinguished from general tags.
+        "tag_string_artist": "",
+        "tag_string_character": "",
+        "tag_string_copyright": "",
+    }
+    for (field, value) in fields.items():
+        sized = field.endswith(("_width", "_height", "file_size"))
+        if sized and value.isdigit():
+            data[field] = int(value)
+    if fields.get("file_url"):
+        data["file_url"] = fields["file_url"]
+        path = urllib.parse.urlparse(data["file_url"]).path
+        data["file_ext"] = os.path.splitext(path)[1].lstrip(".")
+    return data
+
+
+def get_xml_items(url, params, tag, convert):
+    """Make a GET request and return the items in the XML response.
+
+    The response is parsed as it arrives, and each item is discarded
+    from the tree once read, so large pages are never held whole.
+
+    Args:
+        url (str): Webpage link to make a request to.
+        params (dict): Parameters to pass to URL.
+        tag (str): Name of the elements that are items.
+        convert (callable): Function returning an item from its element.
+
+    Raises:
+        requests.RequestException: If the request is unsuccessful.
+        xml.etree.ElementTree.ParseError: If the response isn't XML.
+    """
+    items = []
+    with send_request(url, params=params, stream=True) as response:
+        LOGGER.debug(f"status = {response.status_code}")
+        response.raise_for_status()
+        response.raw.decode_content = True
+        events = xml.etree.ElementTree.iterparse(response.raw)
+        for (_, element) in events:
+            if element.tag == tag:
+                items.append(convert(element))
+                element.clear()
+        log_event(
+            "response", url=response.url, status=response.status_code,
+            bytes=response.raw.tell(),
+            seconds=response.elapsed.total_seconds()
+        )
+    LOGGER.debug(f"{tag}s = {len(items)}")
+    return items
+
+
+def get_xml_posts(url, params):
+    """Make a GET request and return the posts in the XML response.
+
+    See get_xml_items for the errors.
+    """
+    return get_xml_items(url, params, "post", xml_post)
+
+
+class Danbooru:
+
+    """Imageboard with a Danbooru-like JSON API."""
+
+    # Most tags a search may have without an account, or None if there's
+    # no limit.
+    tag_limit = 2
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.url!r})"
+
+    def posts(self, tags, limit):
+        """Return a list of random posts tagged with `tags`."""
+        params = {
+            "limit": limit,
+            "tags": " ".join(tags),
+            "random": "true",
+        }
+        posts = get_json(f"{self.url}/posts.json", params)
+        for data in posts:
+            add_variant_sizes(data)
+        return posts
+
+    def filter_tags(self, screen, scale):
+        """Return metatags leaving out posts that can't be wallpapers.
+
+        They're in the order they narrow a search down, most first.
+        Everything they check is checked again by rejection_reason, so
+        they can be left out of searches without room for them.
+
+        Args:
+            screen ((int, int)): Screen height and width.
+            scale (float): Relative image in relation to the screen.
+        """
+        tags = size_tags(screen, scale)
+        filetypes = ",".join(
+            extension for extension in IMAGE_EXTENSIONS
+            if extension != "jpeg"
+        )
+        tags.append(f"filetype:{filetypes}")
+        return tags
+
+    def tag_counts(self, names):
+        """Return the number of posts with each tag, by name."""
+        params = {
+            "search[name_comma]": ",".join(names),
+            "only": "name,post_count",
+            "limit": len(names),
+        }
+        tags = get_json(f"{self.url}/tags.json", params)
+        # Tags nobody has used aren't listed.
+        counts = dict.fromkeys(names, 0)
+        counts.update((tag["name"], tag["post_count"]) for tag in tags)
+        return counts
+
+    def post_url(self, post_id):
+        """Return the link to a post's page."""
+        return f"{self.url}/posts/{post_id}"
+
+    def file_url(self, data, variant=None):
+        """Return the absolute link to a rendition of a post's image.
+
+        See variant_url for the arguments.
+        """
+        return urllib.parse.urljoin(
+            f"{self.url}/", variant_url(data, variant)
+        )
+
+
+class Gelbooru(Danbooru):
+
+    """Imageboard with a Gelbooru-like XML API."""
+
+    tag_limit = None
+
+    def posts(self, tags, limit):
+        params = {
+            "page": "dapi",
+            "s": "post",
+            "q": "index",
+            "limit": limit,
+            "tags": " ".join(tags + ["sort:random"]),
+        }
+        return get_xml_posts(f"{self.url}/index.php", params)
+
+    def filter_tags(self, screen, scale):
+        # There's no metatag for file types.
+        return size_tags(screen, scale)
+
+    def tag_counts(self, names):
+        params = {
+            "page": "dapi",
+            "s": "tag",
+            "q": "index",
+            "names": " ".join(names),
+        }
+        tags = get_xml_items(
+            f"{self.url}/index.php", params, "tag",
+            lambda element: (element.get("name"), int(element.get("count")))
+        )
+        counts = dict.fromkeys(names, 0)
+        counts.update(tags)
+        return counts
+
+    def post_url(self, post_id):
+        return f"{self.url}/index.php?page=post&s=view&id={post_id}"
+
+
+class Moebooru(Danbooru):
+
+    """Imageboard with a Moebooru-like XML API."""
+
+    # Six, less the one used to order the posts randomly.
+    tag_limit = 5
+
+    def posts(self, tags, limit):
+        params = {
+            "limit": limit,
+            "tags": " ".join(tags + ["order:random"]),
+        }
+        return get_xml_posts(f"{self.url}/post.xml", params)
+
+    def filter_tags(self, screen, scale):
+        return size_tags(screen, scale)
+
+    def tag_counts(self, names):
+        # Tags can only be searched by pattern, so counts aren't worth
+        # the requests.
+        return {}
+
+    def post_url(self, post_id):
+        return f"{self.url}/post/show/{post_id}"
+
+
+BACKENDS = {
+    "danbooru": Danbooru,
+    "gelbooru": Gelbooru,
+    "moebooru": Moebooru,
+}
+
+
+def imageboard_backend(imageboard):
+    """Return the backend for an imageboard written as [API:]URL.
+
+    Raises:
+        ValueError: If the API isn't supported.
+    """
+    match = re.fullmatch(r"(\w+):(https?://.+)", imageboard)
+    if match is None:
+        return Danbooru(imageboard)
+    (api, url) = match.groups()
+    try:
+        backend = BACKENDS[api]
+    except KeyError:
+        raise ValueError(f"{api!r} imageboards are not supported.") from None
+    return backend(url)
+
+
+def is_large_enough(data, screen, scale):
+    """Return whether an image is at least `scale` times the screen."""
+    (screen_height, screen_width) = screen
+    return (
+        data["image_height"] >= screen_height * scale and
+        data["image_width"] >= screen_width * scale
+    )
+
+
+def add_variant_sizes(data):
+    """Fill in the sizes of a Danbooru post's sample and preview.
+
+    Danbooru only lists them with the renditions of the post's media
+    asset, so they're copied to where IMAGE_VARIANTS looks for them.
+    """
+    asset = data.get("media_asset") or {}
+    for rendition in asset.get("variants") or ():
+        for (url_field, width_field, height_field) in IMAGE_VARIANTS.values():
+            if width_field not in data and data.get(url_field) and (
+                    rendition.get("url") == data[url_field]):
+                data[width_field] = rendition.get("width")
+                data[height_field] = rendition.get("height")
+
+
+def size_tags(screen, scale):
+    """Return metatags for images at least `scale` times the screen."""
+    if not scale:
+        return []
+    (screen_height, screen_width) = screen
+    return [
+        f"width:>={math.ceil(screen_width * scale)}",
+        f"height:>={math.ceil(screen_height * scale)}",
+    ]
+
+
+def rejection_reason(data, screen, scale):
+    """Return why a post can't be used as a wallpaper, or None if it can."""
+    # Deleted and restricted posts have no file to download.
+    if "file_url" not in data:
+        return "no file"
+    # Videos, animations and archives can't be edited.
+    if (data.get("file_ext") or "").lower() not in IMAGE_EXTENSIONS:
+        return "not an image"
+    if not is_large_enough(data, screen, scale):
+        return "too small"
+    return None
+
+
+def parse_query(tags):
+    """Return the parts of a Danbooru-like tag search.
+
+    Returns:
+        dict: Sets of the tags to "include" and "exclude", the first
+            letters of the ratings allowed ("ratings", empty meaning
+            any) and disallowed ("not_ratings"), and a list of the
+            "other" metatags.
+    """
+    query = {
+        "include": set(),
+        "exclude": set(),
+        "ratings": set(),
+        "not_ratings": set(),
+        "other": [],
+    }
+    for tag in tags:
+        tag = tag.lower()
+        negated = tag.startswith("-")
+        name = tag[1:] if negated else tag
+        if name.startswith("rating:"):
+            letters = {
+                rating[:1] for rating in name[len("rating:"):].split(",")
+            }
+            query["not_ratings" if negated else "ratings"] |= letters
+        elif ":" in name:
+            query["other"].append(tag)
+        else:
+            query["exclude" if negated else "include"].add(name)
+    return query
+
+
+def plan_search(tags, budget, counts=None, filters=()):
+    """Split a search into tags for the server and a query for the rest.
+
+    When there are more tags than the server allows, the tags that
+    narrow the search down the most are sent: included tags with the
+    fewest posts, then metatags, which can't be checked afterwards, then
+    ratings, then excluded tags with the most posts. The rest are left
+    to be checked on the posts that come back. Any room left over goes
+    to `filters`.
+
+    Args:
+        tags ([str]): Labels the image must match.
+        budget (int): Most tags the server allows, or None if there's no
+            limit.
+        counts (dict): Number of posts with each tag, by name. Defaults
+            to None, meaning the order of `tags` is kept.
+        filters ([str]): Metatags from filter_tags, most important
+            first. Defaults to none.
+
+    Returns:
+        ([str], dict): The tags to send, and a query from parse_query
+            of the rest of `tags`, or None if they can all be sent.
+    """
+    if budget is None or len(tags) + len(filters) <= budget:
+        return ([*tags, *filters], None)
+    if len(tags) <= budget:
+        return ([*tags, *filters[:budget - len(tags)]], None)
+    counts = counts or {}
+    (includes, excludes, ratings, others) = ([], [], [], [])
+    for tag in tags:
+        name = tag.lower().lstrip("-")
+        if name.startswith("rating:"):
+            ratings.append(tag)
+        elif ":" in name:
+            others.append(tag)
+        elif tag.startswith("-"):
+            excludes.append(tag)
+        else:
+            includes.append(tag)
+    unknown = float("inf")
+    includes.sort(key=lambda tag: counts.get(tag.lower(), unknown))
+    excludes.sort(key=lambda tag: -counts.get(tag.lower().lstrip("-"), 0))
+    ordered = includes + others + ratings + excludes
+    (sent, rest) = (ordered[:budget], ordered[budget:])
+    unchecked = [tag for tag in rest if tag in others]
+    if unchecked:
+        LOGGER.warning(
+            f"Too many tags, so {' '.join(unchecked)} will be ignored."
+        )
+    return (sent, parse_query(rest))
+
+
+def matches_query(data, query):
+    """Return whether a post matches a query from parse_query."""
+    tags = set(data.get("tag_string", "").split())
+    rating = (data.get("rating") or "")[:1].lower()
+    return (
+        query["include"] <= tags and
+        not query["exclude"] & tags and
+        (not query["ratings"] or rating in query["ratings"]) and
+        rating not in query["not_ratings"]
+    )
+
+
+@contextlib.contextmanager
+def connect_database(path):
+    """Context manager for an SQLite connection that commits on success."""
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class PostIndex:
+
+    """SQLite database of every post seen, shown or rejected."""
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS posts (
+                    imageboard TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    md5 TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    tags TEXT,
+                    rejection TEXT,
+                    times_shown INTEGER NOT NULL DEFAULT 0,
+                    first_seen REAL NOT NULL,
+                    last_shown REAL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (imageboard, id)
+                )
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS posts_md5 ON posts (md5)"
+            )
+            # Inverted index of tags, for searching offline.
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS post_tags (
+                    tag TEXT NOT NULL,
+                    imageboard TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    PRIMARY KEY (tag, imageboard, id)
+                ) WITHOUT ROWID
+            """)
+            # Number of posts with each tag, for planning searches.
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tag_counts (
+                    imageboard TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (imageboard, name)
+                )
+            """)
+            (unindexed,) = connection.execute(
+                "SELECT NOT EXISTS (SELECT 1 FROM post_tags)"
+            ).fetchone()
+            if unindexed:
+                rows = connection.execute(
+                    "SELECT imageboard, id, tags FROM posts"
+                ).fetchall()
+                connection.executemany(
+                    "INSERT OR IGNORE INTO post_tags VALUES (?, ?, ?)",
+                    [
+                        (tag, imageboard, post_id)
+                        for (imageboard, post_id, tags) in rows
+                        for tag in (tags or "").split()
+                    ]
+                )
+
+    def connect(self):
+        """Context manager for a connection that commits on success."""
+        return connect_database(self.path)
+
+    def record_seen(self, posts, reasons):
+        """Store posts, along with why each was rejected, if it was."""
+        now = time.time()
+        rows = [
+            (
+                data["imageboard"], data["id"], data.get("md5"),
+                data.get("image_width"), data.get("image_height"),
+                data.get("tag_string"), reason, now, json.dumps(data),
+            )
+            for (data, reason) in zip(posts, reasons)
+        ]
+        with self.connect() as connection:
+            connection.executemany("""
+                INSERT INTO posts (
+                    imageboard, id, md5, width, height, tags, rejection,
+                    first_seen, data
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (imageboard, id) DO UPDATE SET
+                    md5 = excluded.md5,
+                    width = excluded.width,
+                    height = excluded.height,
+                    tags = excluded.tags,
+                    rejection = excluded.rejection,
+                    data = excluded.data
+            """, rows)
+            keys = [(data["imageboard"], data["id"]) for data in posts]
+            connection.executemany(
+                "DELETE FROM post_tags WHERE imageboard = ? AND id = ?", keys
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO post_tags VALUES (?, ?, ?)",
+                [
+                    (tag, data["imageboard"], data["id"])
+                    for data in posts
+                    for tag in data.get("tag_string", "").split()
+                ]
+            )
+
+    def record_shown(self, data):
+        """Count a post as having been set as the wallpaper."""
+        self.record_seen([data], [None])
+        with self.connect() as connection:
+            connection.execute("""
+                UPDATE posts
+                SET times_shown = times_shown + 1, last_shown = ?
+                WHERE imageboard = ? AND id = ?
+            """, (time.time(), data["imageboard"], data["id"]))
+
+    def search(self, tags):
+        """Return the posts matching a tag search, as Danbooru would.
+
+        Tags and negated tags are looked up in the inverted index, and
+        rating metatags are checked afterwards. Other metatags are
+        ignored.
+        """
+        query = parse_query(tags)
+        include = sorted(query["include"])
+        sql = "SELECT post.data FROM posts AS post"
+        conditions = []
+        params = []
+        if include:
+            # Start from the posts with one of the tags.
+            sql = """
+                SELECT post.data FROM post_tags AS first
+                JOIN posts AS post USING (imageboard, id)
+            """
+            conditions.append("first.tag = ?")
+            params.append(include.pop(0))
+        tagged = """
+            EXISTS (SELECT 1 FROM post_tags AS tagged WHERE tagged.tag = ?
+                    AND tagged.imageboard = post.imageboard
+                    AND tagged.id = post.id)
+        """
+        for tag in include:
+            conditions.append(tagged)
+            params.append(tag)
+        for tag in sorted(query["exclude"]):
+            conditions.append(f"NOT {tagged}")
+            params.append(tag)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self.connect() as connection:
+            rows = connection.execute(sql, params).fetchall()
+        posts = [json.loads(data) for (data,) in rows]
+        return [data for data in posts if matches_query(data, query)]
+
+    def tag_counts(self, imageboard, names, since):
+        """Return the post counts of tags stored since a time, by name."""
+        with self.connect() as connection:
+            rows = connection.execute(f"""
+                SELECT name, count FROM tag_counts
+                WHERE imageboard = ? AND updated >= ?
+                AND name IN ({", ".join("?" * len(names))})
+            """, (imageboard, since, *names)).fetchall()
+        return dict(rows)
+
+    def record_tag_counts(self, imageboard, counts):
+        """Store the post counts of tags, by name."""
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany("""
+                INSERT INTO tag_counts VALUES (?, ?, ?, ?)
+                ON CONFLICT (imageboard, name) DO UPDATE SET
+                    count = excluded.count,
+                    updated = excluded.updated
+            """, [
+                (imageboard, name, count, now)
+                for (name, count) in counts.items()
+            ])
+
+    def shown_posts(self):
+        """Return every post that has been set as the wallpaper."""
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT data FROM posts WHERE last_shown IS NOT NULL"
+            ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def shown_since(self, since):
+        """Return the posts and MD5s shown since a time."""
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT imageboard, id, md5 FROM posts WHERE last_shown >= ?",
+                (since,)
+            ).fetchall()
+        posts = {(imageboard, post_id) for (imageboard, post_id, _) in rows}
+        md5s = {md5 for (_, _, md5) in rows if md5 is not None}
+        return (posts, md5s)
+
+
+def filter_candidates(posts, screen, scale, index=None, repeat=0,
+                      record=True):
+    """Return the posts that can be used as wallpapers.
+
+    Args:
+        posts ([dict]): Posts to choose from.
+        screen ((int, int)): Screen height and width.
+        scale (float): Relative image in relation to the screen.
+        index (PostIndex): Where to record the posts seen. Defaults to
+            None.
+        repeat (float): Days before a post may be shown again. Defaults
+            to 0.
+        record (bool): Whether to add the posts to `index`. Defaults to
+            True.
+
+    Returns:
+        [dict]: The posts that meet all requirements.
+    """
+    reasons = [rejection_reason(data, screen, scale) for data in posts]
+    if index is not None and repeat:
+        day = 24 * 60 * 60
+        (shown, md5s) = index.shown_since(time.time() - repeat * day)
+        for (position, data) in enumerate(posts):
+            recent = (
+                (data["imageboard"], data["id"]) in shown or
+                data.get("md5") in md5s
+            )
+            if reasons[position] is None and recent:
+                reasons[position] = "shown recently"
+    if index is not None and record:
+        index.record_seen(posts, reasons)
+    return [data for (data, reason) in zip(posts, reasons) if reason is None]
+
+
+def read_pool(pool_path, tags, imageboards):
+    """Return the stored candidate posts for a search, if any."""
+    try:
+        pool = read_json(pool_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+    same_search = (
+        pool.get("imageboards") == imageboards and pool.get("tags") == tags
+    )
+    if not same_search:
+        return []
+    return pool["posts"]
+
+
+def write_pool(pool_path, tags, imageboards, posts):
+    """Store candidate posts for later searches with the same tags."""
+    pool = {"imageboards": imageboards, "tags": tags, "posts": posts}
+    write_json(pool_path, pool)
+
+
+def return_to_pool(pool_path, tags, imageboards, data):
+    """Put a post back first in the pool, to be tried again next time."""
+    data = {key: value for (key, value) in data.items() if key != "variant"}
+    pool = read_pool(pool_path, tags, imageboards)
+    write_pool(pool_path, tags, imageboards, [data] + pool)
+
+
+class InlineExecutor(concurrent.futures.Executor):
+
+    """Executor that makes each call as it's submitted, in the same thread.
+
+    Used instead of the thread and process pools when profiling, since
+    a profiler only sees the thread it was started in.
+    """
+
+    def submit(self, function, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as ex:
+            future.set_exception(ex)
+        else:
+            future.set_result(result)
+        return future
+
+
+def run_inline():
+    """Make the work meant for the thread and process pools run inline."""
+    global _EXECUTOR, _PROCESS_POOL
+    _EXECUTOR = InlineExecutor()
+    _PROCESS_POOL = InlineExecutor()
+
+
+def process_pool():
+    """Return the shared process pool, starting it if necessary."""
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = concurrent.futures.ProcessPoolExecutor()
+    return _PROCESS_POOL
+
+
+def run_blocking(function, *args, **kwargs):
+    """Return a future of a blocking call run in the shared executor.
+
+    The call sees the context variables of the caller, like _DEADLINE.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    call = functools.partial(function, *args, **kwargs)
+    context = contextvars.copy_context()
+    return loop.run_in_executor(_EXECUTOR, context.run, call)
+
+
+def discard_exception(future):
+    """Retrieve the exception of an abandoned future, so it's not logged.
+
+    Meant as a done callback for futures nothing may await anymore.
+    """
+    if not future.cancelled():
+        future.exception()
+
+
+async def fetch_image_data(tags, imageboards, attempts=1, scale=1.0,
+                           pool_path=None, screen=None, hedge=1, index=None,
+                           repeat=0):
     """Return an image's metadata if it matches the requirements.
 
+    A page of random posts is fetched per attempt, and the posts that
+    meet the requirements but aren't used are kept in a pool at
+    `pool_path`, so later calls can skip the request altogether.
+    Attempts are made `hedge` at a time on every imageboard at once,
+    and the first page with a suitable post wins, so a slow or failing
+    imageboard doesn't hold up the rest.
+
     Args:
         tags ([str]): Labels the image must match.
-        imageboard (str): URL of the website to get images from.
+        imageboards ([str]): [API:]URLs of the websites to get images
+            from.
         attempts (int): Number of times to try to get a valid image.
             Defaults to 1.
         scale (float): Relative image in relation to the screen.
             Defaults to 1.0.
+        pool_path (str): Location of the candidate pool. Defaults to
+            None, meaning no pool is kept.
+        screen ((int, int)): Screen height and width. Defaults to None,
+            meaning they are detected.
+        hedge (int): Number of attempts to make at once. Defaults to 1.
+        index (PostIndex): Record of the posts seen before. Defaults to
+            None.
+        repeat (float): Days before a post in `index` may be shown
+            again. Defaults to 0.
 
     Returns:
-        dict: Data stored about the retrieved image.
+        dict: Data stored about the retrieved image, with the
+            imageboard it came from under "imageboard".
 
     Raises:
         ValueError: If none of the images fetched meet all requirements.
+        ConnectionError: If no imageboard could be reached.
     #     ValueError: If there are too many tags, or there were no images
     #         tagged with them all.
     """
-    url = f"{imageboard}/posts.json"
-    params = {
-        "limit": 1,
-        "tags": " ".join(tags),
-        "random": "true",
+    import asyncio
+    import requests
+    backends = {
+        imageboard: imageboard_backend(imageboard)
+        for imageboard in imageboards
     }
-    (screen_height, screen_width) = screen_dimensions()
-    for attempt in range(attempts):
-        # `attempt` is zero-based, but humans aren't.
-        real_attempt = attempt + 1
-        print(f"Attempt {real_attempt}: Getting image...")
-        # try:
-        data = get_json(url, params)[0]
-        # except urllib.error.HTTPError as ex:
-        #     LOGGER.error(ex)
-        #     raise ValueError("Too many tags.") from None
-        # except json.JSONDecodeError as ex:
-        #     LOGGER.error(ex)
-        #     raise ValueError(f"{url} does not have JSON data.")
-        # except ValueError as ex:
-        #     LOGGER.error(ex)
-        #     raise ValueError("Invalid/conflicting tags.") from None
-        good_size = (
-            data["image_height"] >= screen_height * scale and
-            data["image_width"] >= screen_width * scale
-        )
-        if good_size:
-            return data
-    raise ValueError("No images were large enough.")
+    if screen is None:
+        screen = screen_dimensions()
+    candidates = []
+    if pool_path is not None:
+        pool = read_pool(pool_path, tags, imageboards)
+        # The screen or scale may have changed since the pool was made.
+        candidates = filter_candidates(pool, screen, scale, index, repeat)
+        LOGGER.debug(f"pooled candidates = {len(candidates)}")
+    attempt = 0
+    failures = 0
+    plans = {}
+    tasks = []
+    try:
+        while attempt < attempts and not candidates:
+            if not plans:
+                # Each imageboard is searched as soon as its own plan is
+                # ready, so one slow to give tag counts holds up no
+                # others.
+                plans = {
+                    imageboard: run_blocking(
+                        search_plan, backend, imageboard, tags, screen,
+                        scale, index
+                    )
+                    for (imageboard, backend) in backends.items()
+                }
+            wave = []
+            for _ in range(min(hedge, attempts - attempt)):
+                # `attempt` is zero-based, but humans aren't.
+                real_attempt = attempt + 1
+                print(f"Attempt {real_attempt}: Getting images...")
+                for (imageboard, backend) in backends.items():
+                    task = asyncio.ensure_future(fetch_planned_posts(
+                        imageboard, backend, plans[imageboard]
+                    ))
+                    task.add_done_callback(discard_exception)
+                    wave.append(task)
+                attempt += 1
+            tasks += wave
+            for request in asyncio.as_completed(wave):
+                try:
+                    posts = await request
+                except (requests.RequestException, ValueError,
+                        xml.etree.ElementTree.ParseError) as ex:
+                    LOGGER.warning(f"Could not get images: {ex}")
+                    failures += 1
+                    continue
+                candidates = filter_candidates(
+                    posts, screen, scale, index, repeat
+                )
+                LOGGER.debug(f"candidates = {len(candidates)}/{len(posts)}")
+                if candidates:
+                    break
+    finally:
+        # Slower attempts are abandoned, and their requests give up
+        # once the Deadline is cancelled.
+        for future in tasks + list(plans.values()):
+            future.cancel()
+    if not candidates:
+        if failures == attempt * len(backends):
+            raise ConnectionError("No imageboards could be reached.")
+        raise ValueError("No images met the requirements.")
+    data = candidates.pop(0)
+    if pool_path is not None:
+        write_pool(pool_path, tags, imageboards, candidates)
+    return data
+
+
+def local_image_data(tags, index, cache_dir, screen, scale=1.0, repeat=0,
+                     oversample=1.0):
+    """Return the metadata of a downloaded image matching the requirements.
+
+    No network is needed, as the search is answered from the posts in
+    `index` whose originals are still in the cache.
+
+    Args:
+        tags ([str]): Labels the image must match.
+        index (PostIndex): Record of the posts seen before.
+        cache_dir (str): Location of the cache of originals.
+        screen ((int, int)): Screen height and width.
+        scale (float): Relative image in relation to the screen.
+            Defaults to 1.0.
+        repeat (float): Days before a post may be shown again. Defaults
+            to 0.
+        oversample (float): See image_variants. Defaults to 1.0.
+
+    Returns:
+        dict: Data stored about the image.
+
+    Raises:
+        ValueError: If no downloaded images meet all requirements.
+    """
+    posts = [
+        data for data in index.search(tags)
+        if cached_variant(data, cache_dir, screen, oversample) is not None
+    ]
+    candidates = filter_candidates(
+        posts, screen, scale, index, repeat, record=False
+    )
+    LOGGER.debug(f"local candidates = {len(candidates)}/{len(posts)}")
+    if not candidates:
+        raise ValueError("No downloaded images met the requirements.")
+    return random.choice(candidates)
+
+
+def search_plan(backend, imageboard, tags, screen, scale, index=None):
+    """Return the tags to send to an imageboard and a query for the rest.
+
+    As many of the imageboard's filter_tags for the screen and scale
+    are sent as there's room for. If there are too many tags, their
+    post counts are looked up, and kept in `index` for TAG_COUNT_AGE
+    seconds. See plan_search for the return value.
+    """
+    import requests
+    budget = backend.tag_limit
+    filters = backend.filter_tags(screen, scale)
+    if budget is None or len(tags) <= budget:
+        (sent, query) = plan_search(tags, budget, filters=filters)
+        LOGGER.debug(f"{imageboard} searches for {sent}")
+        return (sent, query)
+    names = sorted({
+        tag.lower().lstrip("-") for tag in tags if ":" not in tag
+    })
+    counts = {}
+    if index is not None:
+        since = time.time() - TAG_COUNT_AGE
+        counts = index.tag_counts(imageboard, names, since)
+    missing = [name for name in names if name not in counts]
+    if missing:
+        try:
+            fetched = backend.tag_counts(missing)
+        except (requests.RequestException, ValueError,
+                xml.etree.ElementTree.ParseError) as ex:
+            LOGGER.warning(f"Could not get tag counts: {ex}")
+            fetched = {}
+        if index is not None and fetched:
+            index.record_tag_counts(imageboard, fetched)
+        counts.update(fetched)
+    (sent, query) = plan_search(tags, budget, counts, filters)
+    LOGGER.debug(f"{imageboard} searches for {sent}")
+    return (sent, query)
+
+
+async def fetch_posts(imageboard, backend, tags, query=None):
+    """Return a page of random posts, marked with their imageboard.
+
+    Args:
+        query (dict): Query from parse_query the posts must also match,
+            for tags the imageboard couldn't be sent. Defaults to None.
+    """
+    posts = await run_blocking(backend.posts, tags, POOL_SIZE)
+    if query is not None:
+        matching = [data for data in posts if matches_query(data, query)]
+        LOGGER.debug(f"matching = {len(matching)}/{len(posts)}")
+        posts = matching
+    for data in posts:
+        data["imageboard"] = imageboard
+    return posts
+
+
+async def fetch_planned_posts(imageboard, backend, plan):
+    """Return a page of random posts once the search has been planned.
+
+    Args:
+        plan (asyncio.Future): Result of search_plan for the imageboard.
+    """
+    (tags, query) = await plan
+    return await fetch_posts(imageboard, backend, tags, query)
+
+
+def get_image_data(*args, **kwargs):
+    """Return an image's metadata if it matches the requirements.
+
+    See fetch_image_data for the arguments.
+    """
+    import asyncio
+    return asyncio.run(fetch_image_data(*args, **kwargs))
+
+
+def variant_url(image_data, variant=None):
+    """Return the link to a rendition of a post's image.
+
+    Args:
+        image_data (dict): Data stored about the image.
+        variant (str): Name of the rendition in IMAGE_VARIANTS. Defaults
+            to None, meaning the one downloaded, under "variant", or
+            else the original.
+    """
+    variant = variant or image_data.get("variant", "original")
+    (url_field, _, _) = IMAGE_VARIANTS[variant]
+    return image_data[url_field]
+
+
+def image_variants(image_data, screen, oversample=1.0):
+    """Return the renditions of an image that are large enough to use.
+
+    A rendition is large enough if it's at least the size the original
+    would be shrunk to when edited, so using it loses no detail.
+
+    Args:
+        image_data (dict): Data stored about the image.
+        screen ((int, int)): Screen height and width.
+        oversample (float): Ratio of the size to cover relative to the
+            screen, with 0 meaning the original size is kept. Defaults
+            to 1.0.
+
+    Returns:
+        [str]: Names of the renditions in IMAGE_VARIANTS, smallest
+            first, always ending with "original".
+    """
+    size = (image_data.get("image_width"), image_data.get("image_height"))
+    target = None
+    if all(size) and oversample:
+        target = cover_size(size, screen, oversample)
+    if target is None:
+        return ["original"]
+    variants = []
+    urls = set()
+    for (variant, fields) in IMAGE_VARIANTS.items():
+        (url, width, height) = (image_data.get(field) for field in fields)
+        if variant == "original":
+            break
+        if not url or url == image_data.get("file_url") or url in urls:
+            continue
+        path = urllib.parse.urlparse(url).path
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        usable = (
+            extension in IMAGE_EXTENSIONS and width and height and
+            width >= target[0] and height >= target[1]
+        )
+        if usable:
+            variants.append(variant)
+            urls.add(url)
+    variants.append("original")
+    return variants
 
 
 def booru_image_path(image_data, wallpapers_dir):
     """Return the path of a booru image."""
-    filename = os.path.basename(image_data["file_url"])
-    return os.path.join(wallpapers_dir, filename)
+    path = urllib.parse.urlparse(variant_url(image_data)).path
+    return os.path.join(wallpapers_dir, os.path.basename(path))
 
 
-def remove_old_wallpapers(limit, directories):
-    """Delete old wallpapers if there are too many in the folders."""
-    print("Removing old wallpapers...")
-    for directory in directories:
-        wallpapers = sorted_files(directory)
-        num_extra = len(wallpapers) - limit
-        if num_extra > 0:
-            for wallpaper in wallpapers[:num_extra]:
-                os.remove(wallpaper)
+def cached_image_path(image_data, cache_dir, variant=None):
+    """Return the path of a booru image in the cache of originals.
+
+    Images are stored by their MD5, so the same image is only ever
+    downloaded once, no matter how it was found. Renditions other than
+    the original have their name added.
+
+    Args:
+        variant (str): See variant_url.
+    """
+    md5 = image_data.get("md5")
+    if md5 is None:
+        md5 = hashlib.md5(image_data["file_url"].encode()).hexdigest()
+    variant = variant or image_data.get("variant", "original")
+    path = urllib.parse.urlparse(variant_url(image_data, variant)).path
+    extension = os.path.splitext(path)[1]
+    name = md5 if variant == "original" else f"{md5}-{variant}"
+    return os.path.join(cache_dir, md5[:2], f"{name}{extension}")
+
+
+def cached_variant(image_data, cache_dir, screen, oversample=1.0):
+    """Return the smallest usable rendition of an image that's cached.
+
+    Returns:
+        str: The name of the rendition, or None if none are cached.
+    """
+    for variant in image_variants(image_data, screen, oversample):
+        if os.path.exists(cached_image_path(image_data, cache_dir, variant)):
+            return variant
+    return None
 
 
-def set_linux_wallpaper(path):
-    """Set the desktop wallpaper on GNU/Linux."""
-    desktop = os.environ.get("XDG_CURRENT_DESKTOP").lower()
+def original_image_path(image_data, wallpapers_dir, cache_dir):
+    """Return the path of an unedited booru image, preferring the cache."""
+    path = cached_image_path(image_data, cache_dir)
+    if os.path.exists(path):
+        return path
+    return booru_image_path(image_data, wallpapers_dir)
+
+
+def link_or_copy(source, destination):
+    """Make a file available at another path, without copying if possible."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class FileCache:
+
+    """SQLite index of the files in a directory, for evicting old ones.
+
+    The size and last use of every file is kept, along with running
+    totals, so evicting the least recently used files only touches the
+    files evicted, however many there are. The directory is only listed
+    the first time, to index files that are already there.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, ".files.sqlite3")
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_last_used "
+                "ON files (last_used)"
+            )
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS totals (
+                    files INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            """)
+            # Kept up to date by the database, so they're never summed.
+            connection.executescript("""
+                CREATE TRIGGER IF NOT EXISTS files_insert
+                AFTER INSERT ON files BEGIN
+                    UPDATE totals SET files = files + 1,
+                        bytes = bytes + NEW.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_delete
+                AFTER DELETE ON files BEGIN
+                    UPDATE totals SET files = files - 1,
+                        bytes = bytes - OLD.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_resize
+                AFTER UPDATE OF size ON files BEGIN
+                    UPDATE totals SET bytes = bytes - OLD.size + NEW.size;
+                END;
+            """)
+            (unindexed,) = connection.execute(
+                "SELECT NOT EXISTS (SELECT 1 FROM totals)"
+            ).fetchone()
+            if unindexed:
+                connection.execute("INSERT INTO totals VALUES (0, 0)")
+                connection.executemany(
+                    "INSERT OR IGNORE INTO files VALUES (?, ?, ?)",
+                    self.scan()
+                )
+
+    def connect(self):
+        """Context manager for a connection that commits on success."""
+        return connect_database(self.path)
+
+    def scan(self):
+        """Yield the path, size and modified time of every file."""
+        for (directory, _, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                # Skip the index. Unfinished downloads count too.
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                yield (path, stat.st_size, stat.st_mtime)
+
+    def use(self, path):
+        """Record that a file was just added or used."""
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return
+        with self.connect() as connection:
+            connection.execute("""
+                INSERT INTO files VALUES (?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size,
+                    last_used = excluded.last_used
+            """, (path, size, time.time()))
+
+    def forget(self, path):
+        """Stop keeping track of a file."""
+        with self.connect() as connection:
+            connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def totals(self):
+        """Return the number of files and the bytes they take up."""
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT files, bytes FROM totals"
+            ).fetchone()
+
+    def evict(self, max_bytes=None, max_files=None, keep=()):
+        """Delete the least recently used files until within the limits.
+
+        Args:
+            max_bytes (float): Bytes the files may take up. Defaults to
+                None, meaning no limit.
+            max_files (int): Number of files there may be. Defaults to
+                None, meaning no limit.
+            keep ([str]): Paths of files that must not be deleted.
+                Defaults to none.
+
+        Returns:
+            int: Number of files deleted.
+        """
+        evicted = []
+        with self.connect() as connection:
+            (files, size) = connection.execute(
+                "SELECT files, bytes FROM totals"
+            ).fetchone()
+            rows = connection.execute(
+                "SELECT path, size FROM files ORDER BY last_used"
+            )
+            for (path, file_size) in rows:
+                over_bytes = max_bytes is not None and size > max_bytes
+                over_files = max_files is not None and files > max_files
+                if not (over_bytes or over_files):
+                    break
+                if path in keep:
+                    continue
+                LOGGER.debug(f"evicting {path}")
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                evicted.append((path,))
+                files -= 1
+                size -= file_size
+            connection.executemany(
+                "DELETE FROM files WHERE path = ?", evicted
+            )
+        if evicted:
+            log_event(
+                "evict", directory=self.directory, files=len(evicted),
+                remaining_files=files, remaining_bytes=size
+            )
+        return len(evicted)
+
+
+def linux_desktop():
+    """Return the name of the desktop environment, in lowercase."""
+    return os.environ.get("XDG_CURRENT_DESKTOP", "").lower()
+
+
+def sets_per_output():
+    """Return whether each monitor can be given its own wallpaper.
+
+    Only KDE and feh can, so elsewhere a spanned image is set instead.
+    """
+    if sys.platform != "linux":
+        return False
+    desktop = linux_desktop()
+    return desktop == "kde" or desktop not in LINUX_DESKTOPS
+
+
+def set_linux_wallpaper(path, outputs=None):
+    """Set the desktop wallpaper on GNU/Linux.
+
+    Args:
+        path (str): Path of image to use as wallpaper, which spans every
+            monitor if there are `outputs`.
+        outputs ([str]): Paths of the image for each monitor, if there
+            are several. Defaults to None.
+    """
+    desktop = linux_desktop()
     if desktop in ("gnome", "x-cinnamon", "unity", "pantheon", "budgie:gnome"):
         command = (
             "gsettings set org.gnome.desktop.background picture-uri "
             f"file://{path}"
         )
+        if outputs is not None:
+            command += (
+                " && gsettings set org.gnome.desktop.background "
+                "picture-options spanned"
+            )
     elif desktop == "mate":
         command = (
             "gsettings set org.mate.background picture-uri "
             f"file://{path}"
         )
+        if outputs is not None:
+            command += (
+                " && gsettings set org.mate.background picture-options "
+                "spanned"
+            )
     elif desktop == "kde":
+        # Desktops are matched to images by the screen they're on.
+        images = ", ".join(
+            f"'file://{output}'" for output in outputs or [path]
+        )
         command = (
             "qdbus org.kde.plasmashell /PlasmaShell "
             "org.kde.PlasmaShell.evaluateScript \""
+            f"var images = [{images}];"
             "var allDesktops = desktops();"
             "for(i = 0; i < allDesktops.length; i++) {"
             "d = allDesktops[i];"
@@ -227,7 +2416,8 @@ def set_linux_wallpaper(path):
             "d.currentConfigGroup = Array("
             "'Wallpaper', 'org.kde.image', 'General'"
             ");"
-            f"d.writeConfig('Image', 'file://{path}');"
+            "d.writeConfig('Image', "
+            "images[Math.max(d.screen, 0) % images.length]);"
             "}"
             "\""
         )
@@ -238,6 +2428,9 @@ def set_linux_wallpaper(path):
         )
     elif desktop == "enlightenment":
         command = f"enlightenment_remote -desktop-bg-add 0 0 0 0 {path}"
+    elif outputs is not None:
+        # feh gives each monitor the next image, in Xinerama order.
+        command = f"feh --bg-fill {' '.join(outputs)}"
     else:
         command = f"feh --bg-scale {path}"
         print(textwrap.fill(
@@ -251,8 +2444,24 @@ def set_linux_wallpaper(path):
     subprocess.call(command, shell=True)
 
 
-def set_windows_wallpaper(path):
-    """Set the desktop wallpaper on Windows."""
+def set_windows_wallpaper(path, spanned=False):
+    """Set the desktop wallpaper on Windows.
+
+    Args:
+        path (str): Path of image to use as wallpaper.
+        spanned (bool): Whether the image spans every monitor. Defaults
+            to False.
+    """
+    if spanned:
+        import winreg
+        span_style = "22"
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER,
+                            r"Control Panel\Desktop", 0,
+                            winreg.KEY_SET_VALUE) as key:
+            winreg.SetValueEx(
+                key, "WallpaperStyle", 0, winreg.REG_SZ, span_style
+            )
+            winreg.SetValueEx(key, "TileWallpaper", 0, winreg.REG_SZ, "0")
     spi_setdesktopwallpaper = 20
     spif_sendchange = 2
     irrelevant_param = 0
@@ -269,11 +2478,15 @@ def set_mac_wallpaper(path):
     )
 
 
-def set_wallpaper(path):
+def set_wallpaper(path, outputs=None):
     """Set the desktop wallpaper, regardless of operating system.
 
     Args:
-        path (str): Path of image to use as wallpaper.
+        path (str): Path of image to use as wallpaper, which spans every
+            monitor if there are `outputs`.
+        outputs ([str]): Paths of the image for each monitor, which are
+            used instead where possible. Defaults to None, meaning there
+            is one monitor.
 
     Raises:
         NotImplementedError: If the operating system is not yet
@@ -283,9 +2496,9 @@ def set_wallpaper(path):
     system = sys.platform
     LOGGER.debug(f"system = {system}")
     if system == "linux":
-        set_linux_wallpaper(path)
+        set_linux_wallpaper(path, outputs)
     elif system == "win32":
-        set_windows_wallpaper(path)
+        set_windows_wallpaper(path, spanned=outputs is not None)
     elif system == "darwin":
         set_mac_wallpaper(path)
     else:
@@ -317,6 +2530,19 @@ def nonnegative(num):
     return num
 
 
+def resolution(text):
+    """Return a monitor layout string if it is valid, else raise an error."""
+    if text:
+        return format_monitors(parse_monitors(text))
+    return text
+
+
+def imageboard(text):
+    """Return an imageboard if its API is supported, else raise an error."""
+    imageboard_backend(text)
+    return text
+
+
 def init_argparser():
     """Return an ArgumentParser specialised for this script."""
     percent_meta = "{0.0,...,1.0}"
@@ -331,14 +2557,29 @@ def init_argparser():
     main_parser.add_argument(
         "-v", "--verbose", action="store_true", help="increase verbosity"
     )
+    main_parser.add_argument(
+        "--profile", action="store_true",
+        help="write profiling statistics of the run to data/profile.pstats, "
+        "doing everything in one thread so it can all be seen"
+    )
     subparsers = main_parser.add_subparsers(dest="subcommand")
 
     args = {
         "tags": ("-t", "--tags"),
+        "blacklist": ("-x", "--blacklist"),
         "imageboard": ("-i", "--imageboard"),
         "attempts": ("-a", "--attempts"),
+        "hedge": ("-H", "--hedge"),
+        "timeout": ("-T", "--timeout"),
+        "repeat": ("-n", "--repeat"),
         "scale": ("-s", "--scale"),
+        "resolution": ("-r", "--resolution"),
+        "oversample": ("-o", "--oversample"),
         "keep": ("-k", "--keep"),
+        "cache": ("-C", "--cache"),
+        "edits": ("-E", "--edits"),
+        "connections": ("-c", "--connections"),
+        "rate": ("-R", "--rate"),
         "period": ("-p", "--period"),
         "blur": ("-b", "--blur"),
         "grey": ("-g", "--grey"),
@@ -348,18 +2589,61 @@ def init_argparser():
         "tags": {
             "help": "list of labels images should match",
         },
+        "blacklist": {
+            "help": "list of labels images must not have",
+        },
         "imageboard": {
-            "help": "Danbooru-like site to get images from",
+            "help":
+                "Danbooru-like sites to get images from, as URLs optionally "
+                "prefixed by 'gelbooru:' or 'moebooru:' for those APIs",
         },
         "attempts": {
             "help": "number of times to try to get an image",
         },
+        "hedge": {
+            "help": "number of attempts to make at the same time",
+        },
+        "timeout": {
+            "help":
+                "seconds to wait for imageboards before using a downloaded "
+                "image (a value of 0 means there is no limit)",
+        },
+        "repeat": {
+            "help":
+                "days before an image may be shown again (a value of 0 means "
+                "it may be repeated straight away)",
+        },
         "scale": {
             "help": "minimum image size ratio relative to the screen",
         },
+        "resolution": {
+            "help":
+                "screen size to use instead of detecting it, or the "
+                "WIDTHxHEIGHT+X+Y of each monitor separated by commas (an "
+                "empty value means it will be detected)",
+        },
+        "oversample": {
+            "help":
+                "edited image size ratio relative to the screen (a value of 0 "
+                "means the original size is kept)",
+        },
         "keep": {
             "help": "number of wallpapers to store",
         },
+        "cache": {
+            "help": "megabytes of original images to cache",
+        },
+        "edits": {
+            "help": "megabytes of edited images to cache",
+        },
+        "connections": {
+            "help": "number of connections to keep open per host",
+        },
+        "rate": {
+            "help":
+                "requests per second to allow to each host (a value of 0 "
+                "means there is no limit)",
+        },
         "period": {
             "help":
                 "hours to wait before changing wallpapers (a value of 0 means "
@@ -383,20 +2667,60 @@ def init_argparser():
         *args["tags"], **kwargs["tags"], nargs="*"
     )
     set_subparser.add_argument(
-        *args["imageboard"], **kwargs["imageboard"]
+        *args["blacklist"], **kwargs["blacklist"], nargs="*"
+    )
+    set_subparser.add_argument(
+        *args["imageboard"], **kwargs["imageboard"], nargs="+",
+        type=imageboard
     )
     set_subparser.add_argument(
         *args["attempts"], **kwargs["attempts"], type=natural,
         metavar=natural_meta
     )
+    set_subparser.add_argument(
+        *args["hedge"], **kwargs["hedge"], type=natural,
+        metavar=natural_meta
+    )
+    set_subparser.add_argument(
+        *args["timeout"], **kwargs["timeout"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
+    set_subparser.add_argument(
+        *args["repeat"], **kwargs["repeat"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
     set_subparser.add_argument(
         *args["scale"], **kwargs["scale"], type=nonnegative,
         metavar=nonnegative_float_meta
     )
+    set_subparser.add_argument(
+        *args["resolution"], **kwargs["resolution"], type=resolution,
+        metavar="WIDTHxHEIGHT"
+    )
+    set_subparser.add_argument(
+        *args["oversample"], **kwargs["oversample"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
     set_subparser.add_argument(
         *args["keep"], **kwargs["keep"], type=natural,
         metavar=natural_meta
     )
+    set_subparser.add_argument(
+        *args["cache"], **kwargs["cache"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
+    set_subparser.add_argument(
+        *args["edits"], **kwargs["edits"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
+    set_subparser.add_argument(
+        *args["connections"], **kwargs["connections"], type=natural,
+        metavar=natural_meta
+    )
+    set_subparser.add_argument(
+        *args["rate"], **kwargs["rate"], type=nonnegative,
+        metavar=nonnegative_float_meta
+    )
     set_subparser.add_argument(
         *args["period"], **kwargs["period"], type=nonnegative,
         metavar=nonnegative_int_meta
@@ -432,41 +2756,522 @@ def init_argparser():
         epilog="if no options are specified, reset all"
     )
 
-    subparsers.add_parser(
+    info_subparser = subparsers.add_parser(
         "info", help="view information about the current wallpaper",
         add_help=False
     )
-    subparsers.add_parser(
+    info_subparser.add_argument(
+        "--timings", action="store_true",
+        help="show how long each stage of getting wallpapers takes"
+    )
+    info_subparser.add_argument(
+        "--events", action="store_true",
+        help="show how often things happened and how fast, from the event "
+        "log"
+    )
+    next_subparser = subparsers.add_parser(
         "next", help="get another wallpaper",
         add_help=False
     )
+    next_subparser.add_argument(
+        "--local", action="store_true",
+        help="only use images that have already been downloaded"
+    )
+    reedit_subparser = subparsers.add_parser(
+        "reedit", help="edit the wallpaper again with the current settings",
+        add_help=False
+    )
+    reedit_subparser.add_argument(
+        "--all", action="store_true",
+        help="edit every wallpaper kept, in parallel"
+    )
+    subparsers.add_parser(
+        "daemon", help="keep running, changing the wallpaper every period",
+        add_help=False
+    )
     return main_parser
 
 
-def next_wallpaper(config, image_data_path, wallpapers_dir, edits_dir):
-    """Set the next wallpaper, and write its image data."""
-    data = get_image_data(
-        config["tags"], config["imageboard"], attempts=config["attempts"],
-        scale=config["scale"]
-    )
+def search_tags(config):
+    """Return the tags to search for, including the blacklist negated."""
+    return config["tags"] + [f"-{tag}" for tag in config["blacklist"]]
+
+
+async def prepare_wallpaper_async(config, data_dir, edits_dir, cache_dir,
+                                  local=False):
+    """Get, download and edit the next wallpaper without setting it.
+
+    Trimming the cache happens alongside the edit. If the imageboards
+    can't be reached within the timeout, the image can't be downloaded,
+    or `local` is True, a downloaded image is used instead.
+
+    Raises:
+        ConnectionError: If the imageboards can't be reached and no
+            downloaded images meet the requirements.
+        ValueError: If no images meet the requirements.
+
+    Returns:
+        (dict, str, str, [str], dict): The image data, the path of the
+            original, the path of the edit, which is None if there are
+            no edits, the path of each monitor's render, which is None
+            if there's only one monitor, and the seconds each stage
+            took.
+    """
+    import asyncio
+    import requests
+    timings = {}
+    pool_path = os.path.join(data_dir, "pool.json")
+    screen_path = os.path.join(data_dir, "screen.json")
+    with timed(timings, "screen"):
+        monitors = monitor_geometries(config["resolution"], screen_path)
+    screen = layout_size(monitors)
+    index = PostIndex(os.path.join(data_dir, "posts.sqlite3"))
+    tags = search_tags(config)
+    data = None
+    offline = False
+    if not local:
+        fetching = fetch_image_data(
+            tags, config["imageboard"],
+            attempts=config["attempts"], scale=config["scale"],
+            pool_path=pool_path, screen=screen, hedge=config["hedge"],
+            index=index, repeat=config["repeat"]
+        )
+        # Requests left behind by the timeout or the hedged attempts
+        # give up when the stage is over.
+        deadline = Deadline(config["timeout"])
+        token = _DEADLINE.set(deadline)
+        try:
+            with timed(timings, "metadata"):
+                data = await asyncio.wait_for(
+                    fetching, config["timeout"] or None
+                )
+        except (ConnectionError, asyncio.TimeoutError):
+            print(textwrap.fill(
+                "The imageboards could not be reached in time, so a "
+                "downloaded image will be used."
+            ))
+            offline = True
+        finally:
+            _DEADLINE.reset(token)
+            deadline.cancel()
+    fetched = data is not None
+    if not fetched:
+        data = choose_local_image(
+            config, tags, index, cache_dir, screen, timings, offline
+        )
+    try:
+        original = await fetch_image(
+            data, cache_dir, screen, config["oversample"], timings
+        )
+    except requests.RequestException as ex:
+        LOGGER.warning(f"Could not download the image: {ex}")
+        if fetched:
+            # So a later run can resume the download.
+            return_to_pool(pool_path, tags, config["imageboard"], data)
+        print(textwrap.fill(
+            "The image could not be downloaded, so a downloaded image will "
+            "be used."
+        ))
+        # Anything but an error status means the transfer broke off.
+        offline = not isinstance(ex, requests.HTTPError)
+        data = choose_local_image(
+            config, tags, index, cache_dir, screen, timings, offline
+        )
+        original = await fetch_image(
+            data, cache_dir, screen, config["oversample"], timings
+        )
     # Patch so info subcommand can display source.
-    data["post_url"] = os.path.join(
-        config["imageboard"], "posts", str(data["id"])
+    data["post_url"] = imageboard_backend(data["imageboard"]).post_url(
+        data["id"]
+    )
+    cache = FileCache(cache_dir)
+    cache.use(original)
+    megabyte = 1024 * 1024
+    trimming = run_blocking(
+        call_timed, timings, "trim", cache.evict,
+        max_bytes=config["cache"] * megabyte, keep=(original,)
+    )
+    (edited, outputs) = (None, None)
+    editing = any(config[edit] != 0 for edit in ("blur", "grey", "dim"))
+    if editing or len(monitors) > 1:
+        with timed(timings, "edit"):
+            (edited, outputs) = await run_blocking(
+                render_wallpaper, config, original, edits_dir, monitors,
+                timings=timings
+            )
+    await trimming
+    return (data, original, edited, outputs, timings)
+
+
+def choose_local_image(config, tags, index, cache_dir, screen, timings,
+                       offline=False):
+    """Return the data of a downloaded image to use as the wallpaper.
+
+    Args:
+        offline (bool): Whether the imageboards couldn't be reached.
+            Defaults to False.
+
+    Raises:
+        ConnectionError: If `offline` is True and no downloaded images
+            meet the requirements.
+        ValueError: If `offline` is False and no downloaded images meet
+            the requirements.
+    """
+    with timed(timings, "local"):
+        try:
+            return local_image_data(
+                tags, index, cache_dir, screen, scale=config["scale"],
+                repeat=config["repeat"], oversample=config["oversample"]
+            )
+        except ValueError as ex:
+            if offline:
+                raise ConnectionError(ex) from None
+            raise
+
+
+async def fetch_image(data, cache_dir, screen, oversample, timings):
+    """Return the path of a post's image, downloading it if necessary.
+
+    The smallest rendition that's still large enough is used, and its
+    name is kept in `data` under "variant".
+
+    Raises:
+        requests.RequestException: If the image couldn't be downloaded.
+    """
+    variant = cached_variant(data, cache_dir, screen, oversample)
+    if variant is not None:
+        data["variant"] = variant
+        print("Using cached image.")
+        return cached_image_path(data, cache_dir)
+    data["variant"] = image_variants(data, screen, oversample)[0]
+    LOGGER.debug(f"variant = {data['variant']}")
+    path = cached_image_path(data, cache_dir)
+    url = imageboard_backend(data["imageboard"]).file_url(data)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with timed(timings, "download"):
+            size = await run_blocking(download, url, path)
+    finally:
+        # An unfinished download counts towards the size of the cache
+        # until it's resumed or evicted.
+        FileCache(cache_dir).use(f"{path}.part")
+    timings["download_bytes"] = size
+    timings["download_rate"] = size / (timings["download"] or 1)
+    if data["variant"] != "original" and data.get("file_size"):
+        timings["download_saved"] = max(0, data["file_size"] - size)
+    return path
+
+
+def prepare_wallpaper(config, data_dir, edits_dir, cache_dir):
+    """Get, download and edit the next wallpaper without setting it.
+
+    See prepare_wallpaper_async for the return value and errors.
+    """
+    import asyncio
+    return asyncio.run(
+        prepare_wallpaper_async(config, data_dir, edits_dir, cache_dir)
     )
-    url = config["imageboard"] + data["file_url"]
+
+
+def remove_old_wallpapers(config, path, wallpapers_dir, edits_dir,
+                          cache_dir, original, edits=()):
+    """Mark a wallpaper as used and delete old ones if there are too many.
+
+    Being set as the wallpaper counts as a use of the original and the
+    edits too, so they're the last to be evicted from their caches.
+    """
+    print("Removing old wallpapers...")
+    FileCache(cache_dir).use(original)
+    edits_cache = FileCache(edits_dir)
+    for edit in edits:
+        edits_cache.use(edit)
+    wallpapers = FileCache(wallpapers_dir)
+    wallpapers.use(path)
+    wallpapers.evict(max_files=config["keep"], keep=(path,))
+
+
+async def show_wallpaper_async(config, image_data_path, wallpapers_dir,
+                               edits_dir, cache_dir, prepared, start=None,
+                               since=None):
+    """Set a prepared wallpaper, and write its image data.
+
+    Old wallpapers are removed while the new one is being set, and a
+    "wallpaper" event summarises the change, with the time each stage
+    took and the total since `start`, a time.perf_counter value, if
+    given, and the requests and connections made since `since`, a
+    snapshot from connection_stats, if given.
+    """
+    (data, original, edited, outputs, timings) = prepared
     path = booru_image_path(data, wallpapers_dir)
-    download(url, path)
-    remove_old_wallpapers(config["keep"], (wallpapers_dir, edits_dir))
-    if any(config[edit] != 0 for edit in ("blur", "grey", "dim")):
-        path = edit_booru_wallpaper(config, path, edits_dir)
-    set_wallpaper(path)
-    write_json(image_data_path, data)
+    link_or_copy(original, path)
+    edits = [edit for edit in [edited, *(outputs or ())] if edit is not None]
+    cleanup = run_blocking(
+        call_timed, timings, "cleanup", remove_old_wallpapers, config, path,
+        wallpapers_dir, edits_dir, cache_dir, original, edits
+    )
+    with timed(timings, "set"):
+        await run_blocking(set_wallpaper, edited or path, outputs)
+    data_dir = os.path.dirname(image_data_path)
+    # Written with any changes to the config, so they're never torn.
+    with state_store(data_dir).transaction():
+        config.write()
+        state_store(data_dir).write(image_data_path, data)
+    index = PostIndex(os.path.join(data_dir, "posts.sqlite3"))
+    index.record_shown(data)
+    await cleanup
+    if start is not None:
+        timings["total"] = time.perf_counter() - start
+    (requests, connections) = connections_since(since)
+    log_event(
+        "wallpaper", id=data["id"], imageboard=data["imageboard"],
+        seconds=timings.get("total"), bytes=timings.get("download_bytes", 0),
+        saved=timings.get("download_saved", 0), variant=data.get("variant"),
+        edited=edited is not None,
+        requests=requests, connections=connections, timings=timings
+    )
+
+
+def show_wallpaper(config, image_data_path, wallpapers_dir, edits_dir,
+                   cache_dir, prepared, since=None):
+    """Set a prepared wallpaper, and write its image data.
+
+    See show_wallpaper_async for the arguments.
+    """
+    import asyncio
+    asyncio.run(show_wallpaper_async(
+        config, image_data_path, wallpapers_dir, edits_dir, cache_dir,
+        prepared, since=since
+    ))
+
+
+async def next_wallpaper_async(config, image_data_path, wallpapers_dir,
+                               edits_dir, cache_dir, local=False):
+    """Set the next wallpaper, and write its image data."""
+    start = time.perf_counter()
+    since = connection_stats()
+    data_dir = os.path.dirname(image_data_path)
+    prepared = await prepare_wallpaper_async(
+        config, data_dir, edits_dir, cache_dir, local
+    )
+    await show_wallpaper_async(
+        config, image_data_path, wallpapers_dir, edits_dir, cache_dir,
+        prepared, start, since
+    )
+
+
+def next_wallpaper(config, image_data_path, wallpapers_dir, edits_dir,
+                   cache_dir, local=False):
+    """Set the next wallpaper, and write its image data.
+
+    Args:
+        local (bool): Whether to only use downloaded images, which
+            needs no network. Defaults to False.
+    """
+    import asyncio
+    init_network(config, os.path.dirname(image_data_path))
+    try:
+        asyncio.run(next_wallpaper_async(
+            config, image_data_path, wallpapers_dir, edits_dir, cache_dir,
+            local
+        ))
+    except ConnectionError:
+        print("No internet connection. Please connect to the internet.")
+        sys.exit(126)
+    except ValueError as ex:
+        # No images met the requirements, online or downloaded.
+        print(ex)
+        sys.exit(1)
+
+
+def prefetch_depth(latency, period):
+    """Return how many wallpapers to prepare ahead of time.
+
+    One is enough unless preparing a wallpaper takes a good chunk of
+    the period, in which case more are kept ready.
+    """
+    if not period:
+        return 1
+    depth = 1 + int(4 * latency / period)
+    return min(depth, PREFETCH_LIMIT)
+
+
+class Prefetcher(threading.Thread):
+
+    """Thread that prepares wallpapers before they are due."""
+
+    def __init__(self, config, data_dir, edits_dir, cache_dir):
+        super().__init__(daemon=True)
+        self.config = config
+        self.data_dir = data_dir
+        self.edits_dir = edits_dir
+        self.cache_dir = cache_dir
+        self.prepared = queue.Queue()
+        self.consumed = threading.Event()
+        # Seconds it takes to prepare a wallpaper, on average.
+        self.latency = 0.0
+
+    def settings(self):
+        """Return the options that prepared wallpapers depend on."""
+        return {option: self.config[option] for option in PREPARE_OPTIONS}
+
+    def depth(self):
+        """Return how many wallpapers should be ready."""
+        period = self.config["period"] * 60 * 60
+        return prefetch_depth(self.latency, period)
+
+    def run(self):
+        import requests
+        while True:
+            if self.prepared.qsize() >= self.depth():
+                self.consumed.wait()
+                self.consumed.clear()
+                continue
+            settings = self.settings()
+            start = time.monotonic()
+            try:
+                prepared = prepare_wallpaper(
+                    self.config, self.data_dir, self.edits_dir,
+                    self.cache_dir
+                )
+            except (ValueError, OSError, requests.RequestException) as ex:
+                LOGGER.error(f"Could not prepare a wallpaper: {ex}")
+                log_event("prepare_failed", error=str(ex))
+                time.sleep(RETRY_DELAY)
+                continue
+            except (Exception, SystemExit) as ex:
+                # Ending the thread would leave take waiting forever.
+                LOGGER.exception(f"Could not prepare a wallpaper: {ex!r}")
+                log_event("prepare_failed", error=repr(ex))
+                time.sleep(RETRY_DELAY)
+                continue
+            latency = time.monotonic() - start
+            # Weigh recent attempts more, as the network changes.
+            self.latency = latency if not self.latency else (
+                0.7 * self.latency + 0.3 * latency
+            )
+            LOGGER.debug(f"prepared in {latency:.1f}s, depth {self.depth()}")
+            self.prepared.put((settings, prepared))
+
+    def take(self):
+        """Return the next wallpaper prepared with the current settings.
+
+        If the thread has stopped, the wallpaper is prepared right away
+        instead.
+        """
+        while True:
+            try:
+                (settings, prepared) = self.prepared.get(timeout=1)
+            except queue.Empty:
+                if self.is_alive():
+                    continue
+                LOGGER.error("The prefetcher stopped, preparing a wallpaper")
+                return prepare_wallpaper(
+                    self.config, self.data_dir, self.edits_dir,
+                    self.cache_dir
+                )
+            self.consumed.set()
+            if settings == self.settings():
+                return prepared
+            LOGGER.debug("discarding wallpaper prepared with old settings")
+
+
+def run_daemon(config, image_data_path, wallpapers_dir, edits_dir,
+               cache_dir):
+    """Change the wallpaper every period, preparing each one in advance.
+
+    The config is read again before every change, so settings changed
+    with the set subcommand take effect without restarting.
+    """
+    if not config["period"]:
+        print(textwrap.fill(
+            "The period is 0, so the wallpaper never changes. Please set "
+            "one with `set --period HOURS`."
+        ))
+        sys.exit(2)
+    data_dir = os.path.dirname(image_data_path)
+    init_network(config, data_dir)
+    prefetcher = Prefetcher(config, data_dir, edits_dir, cache_dir)
+    # The session lasts as long as the daemon, so each change reports
+    # the requests made since the last one.
+    since = connection_stats()
+    prefetcher.start()
+    last_change = time.monotonic()
+    store = state_store(data_dir)
+    # Changes are written after each wallpaper change, and on exit.
+    with store.coalesced():
+        while True:
+            deadline = last_change + config["period"] * 60 * 60
+            time.sleep(max(0, deadline - time.monotonic()))
+            config = Config(data_dir)
+            if not config["period"]:
+                # Check again later, in case a period is set.
+                time.sleep(RETRY_DELAY)
+                continue
+            prefetcher.config = config
+            prepared = prefetcher.take()
+            show_wallpaper(
+                config, image_data_path, wallpapers_dir, edits_dir,
+                cache_dir, prepared, since
+            )
+            since = connection_stats()
+            store.flush()
+            last_change = time.monotonic()
+
+
+def format_stage(stage, value):
+    """Return the seconds a stage took, or bytes for the download ones."""
+    if stage in ("download_bytes", "download_saved"):
+        return format_bytes(value)
+    if stage == "download_rate":
+        return f"{format_bytes(value)}/s"
+    return f"{value * 1000:.0f} ms"
+
+
+def format_timings(events):
+    """Return how long each stage took last run and on average."""
+    runs = [event["timings"] for event in events if "timings" in event]
+    if not runs:
+        return "No timings have been recorded yet."
+    last = runs[-1]
+    lines = [f"stage: last run (average of {len(runs)} runs)"]
+    for stage in sorted({stage for timings in runs for stage in timings}):
+        samples = [timings[stage] for timings in runs if stage in timings]
+        mean = sum(samples) / len(samples)
+        # Stages the last run skipped, like downloading a cached image.
+        value = format_stage(stage, last[stage]) if stage in last else "-"
+        lines.append(f"{stage}: {value} ({format_stage(stage, mean)})")
+    return "\n".join(lines)
+
+
+def format_events(events):
+    """Return how many of each event happened, and their throughput."""
+    if not events:
+        return "No events have been recorded yet."
+    hours = (events[-1]["time"] - events[0]["time"]) / 60 / 60
+    lines = [f"{len(events)} events recorded over {hours:.1f} hours"]
+    for name in sorted({event["event"] for event in events}):
+        matching = [event for event in events if event["event"] == name]
+        # Sampled events stand for several.
+        count = sum(event.get("sample", 1) for event in matching)
+        line = f"{name}: {count}"
+        seconds = [
+            event["seconds"] for event in matching
+            if event.get("seconds") is not None
+        ]
+        if seconds:
+            line += f", {sum(seconds) / len(seconds) * 1000:.0f} ms each"
+            size = sum(event.get("bytes", 0) for event in matching)
+            if size:
+                line += f", {format_bytes(size / sum(seconds))}/s"
+        lines.append(line)
+    return "\n".join(lines)
 
 
 def wallpaper_info(image_data_path):
     """Return information about the current wallpaper."""
+    data_dir = os.path.dirname(image_data_path)
     try:
-        data = read_json(image_data_path)
+        data = state_store(data_dir).read(image_data_path)
     except FileNotFoundError:
         print(textwrap.fill(
             "There is no information on the wallpaper, as it was not set "
@@ -485,6 +3290,9 @@ def wallpaper_info(image_data_path):
 
 def blur_image(image, blur_ratio):
     """Return a blurry PIL image."""
+    import PIL.ImageFilter
+    if blur_ratio == 0:
+        return image
     width = max(image.size)
     # Divide by two, otherwise we get a diameter.
     blur_radius = blur_ratio * width / 2
@@ -493,23 +3301,111 @@ def blur_image(image, blur_ratio):
     return new_image
 
 
-def grey_image(image, grey_ratio):
-    """Return a grey PIL image."""
-    enhancer = PIL.ImageEnhance.Color(image)
+def colour_matrix(grey_ratio, dim_ratio):
+    """Return an RGB matrix that greys and then dims an image.
+
+    Greying blends each channel with the luma, and dimming scales the
+    result towards black, so both fit in one linear transform.
+    """
     colour_ratio = 1 - grey_ratio
-    new_image = enhancer.enhance(colour_ratio)
+    bright_ratio = 1 - dim_ratio
+    matrix = []
+    for channel in range(3):
+        for source, weight in enumerate(LUMA):
+            factor = grey_ratio * weight
+            if source == channel:
+                factor += colour_ratio
+            matrix.append(bright_ratio * factor)
+        # No offset.
+        matrix.append(0)
+    return tuple(matrix)
+
+
+def grey_dim_image(image, grey_ratio, dim_ratio):
+    """Return a grey and dimmed PIL image, made in a single pass."""
+    if grey_ratio == 0 and dim_ratio == 0:
+        return image
+    bright_ratio = 1 - dim_ratio
+    if image.mode == "L":
+        # Already grey, so only dimming is left.
+        if dim_ratio == 0:
+            return image
+        return image.point(lambda value: value * bright_ratio)
+    alpha = None
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    if has_alpha:
+        alpha = image.convert("RGBA").getchannel("A")
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if grey_ratio == 1:
+        matrix = tuple(bright_ratio * weight for weight in LUMA) + (0,)
+        new_image = image.convert("L", matrix)
+    else:
+        matrix = colour_matrix(grey_ratio, dim_ratio)
+        new_image = image.convert("RGB", matrix)
+    if alpha is not None:
+        new_image.putalpha(alpha)
     return new_image
 
 
-def dim_image(image, dim_ratio):
-    """Return a dimmed PIL image."""
-    enhancer = PIL.ImageEnhance.Brightness(image)
-    bright_ratio = 1 - dim_ratio
-    new_image = enhancer.enhance(bright_ratio)
-    return new_image
+def cover_size(size, screen, oversample=1.0):
+    """Return the smallest size of an image that still covers the screen.
+
+    Args:
+        size ((int, int)): Image width and height.
+        screen ((int, int)): Screen height and width.
+        oversample (float): Ratio of the size to cover relative to the
+            screen. Defaults to 1.0.
+
+    Returns:
+        (int, int): The new width and height, or None if the image is
+            already small enough.
+    """
+    (width, height) = size
+    (screen_height, screen_width) = screen
+    ratio = max(
+        screen_width * oversample / width, screen_height * oversample / height
+    )
+    if ratio >= 1:
+        return None
+    return (max(1, round(width * ratio)), max(1, round(height * ratio)))
+
 
+def open_for_screen(path, screen=None, oversample=1.0):
+    """Return a PIL image shrunk to cover the screen, if it's larger.
 
-def edit_image(in_path, out_path=None, blurriness=0, greyness=0, dimness=0):
+    JPEGs are decoded at a reduced scale to begin with, so the full
+    image never needs to be held in memory.
+
+    Args:
+        path (str): Location of the image.
+        screen ((int, int)): Screen height and width. Defaults to None,
+            meaning the image is kept at its original size.
+        oversample (float): Ratio of the size to cover relative to the
+            screen, with 0 meaning the original size is kept. Defaults
+            to 1.0.
+
+    Returns:
+        PIL.Image.Image: The opened image.
+    """
+    import PIL.Image
+    image = PIL.Image.open(path)
+    if screen is None or not oversample:
+        return image
+    size = cover_size(image.size, screen, oversample)
+    if size is None:
+        return image
+    LOGGER.debug(f"rendering {image.size} at {size}")
+    # Only picks scales that are still at least `size`.
+    image.draft(None, size)
+    size = cover_size(image.size, screen, oversample)
+    if size is None:
+        return image
+    return image.resize(size, PIL.Image.LANCZOS, reducing_gap=2.0)
+
+
+def edit_image(in_path, out_path=None, blurriness=0, greyness=0, dimness=0,
+               screen=None, oversample=1.0, timings=None):
     """Make an image more/less blurry, grey and dim.
 
     Args:
@@ -522,14 +3418,108 @@ def edit_image(in_path, out_path=None, blurriness=0, greyness=0, dimness=0):
             Defaults to 0.
         dimness (float): How dim it should be, from 0 to 1.
             Defaults to 0.
+        screen ((int, int)): Screen height and width to shrink the image
+            to before editing it. Defaults to None, meaning it keeps its
+            original size.
+        oversample (float): Ratio of the edited image size relative to
+            the screen. Defaults to 1.0.
+        timings (dict): Where to record the seconds spent decoding,
+            filtering and encoding. Defaults to None.
     """
     if out_path is None:
         out_path = in_path
+    with timed(timings, "decode"):
+        image = open_for_screen(in_path, screen, oversample)
+        image.load()
+    with timed(timings, "filter"):
+        image = blur_image(image, blurriness)
+        image = grey_dim_image(image, greyness, dimness)
+    with timed(timings, "encode"):
+        image.save(out_path, quality=EDIT_QUALITY)
+
+
+def span_box(size, layout, monitor):
+    """Return the part of an image a monitor shows when it's spanned.
+
+    The image is centred and scaled to cover the whole layout, like a
+    single wallpaper across every monitor.
+
+    Args:
+        size ((int, int)): Image width and height.
+        layout ((int, int)): Height and width the monitors span.
+        monitor ((int, int, int, int)): Height, width, top and left of
+            the monitor.
+
+    Returns:
+        (float, float, float, float): The left, top, right and bottom of
+            the part, in the image's pixels.
+    """
+    (image_width, image_height) = size
+    (layout_height, layout_width) = layout
+    (height, width, top, left) = monitor
+    # Image pixels per layout pixel.
+    ratio = min(image_width / layout_width, image_height / layout_height)
+    x = (image_width - layout_width * ratio) / 2 + left * ratio
+    y = (image_height - layout_height * ratio) / 2 + top * ratio
+    # Rounding errors mustn't take it past the edges.
+    return (
+        max(0, x), max(0, y), min(image_width, x + width * ratio),
+        min(image_height, y + height * ratio),
+    )
+
+
+def render_output(in_path, out_path, layout, monitor, blurriness=0,
+                  greyness=0, dimness=0, oversample=1.0):
+    """Render and edit the part of an image one monitor shows.
+
+    Meant to be run in a worker process, one per monitor. See span_box
+    for how the image is laid out, and edit_image for the edits, which
+    are relative to the whole layout so they match across monitors.
+
+    Args:
+        in_path (str): Location of the image.
+        out_path (str): Where to save the render.
+        layout ((int, int)): Height and width the monitors span.
+        monitor ((int, int, int, int)): Height, width, top and left of
+            the monitor.
+        oversample (float): Ratio of the render size relative to the
+            monitor, with 0 meaning the image's own pixels are kept.
+            Defaults to 1.0.
+    """
+    import PIL.Image
+    (height, width, _, _) = monitor
     image = PIL.Image.open(in_path)
-    image = blur_image(image, blurriness)
-    image = grey_image(image, greyness)
-    image = dim_image(image, dimness)
-    image.save(out_path)
+    if oversample:
+        size = (round(width * oversample), round(height * oversample))
+        # The whole image only needs to be big enough for this part.
+        box = span_box(image.size, layout, monitor)
+        scale = max(size[0] / (box[2] - box[0]), size[1] / (box[3] - box[1]))
+        image.draft(None, (
+            round(image.width * scale), round(image.height * scale)
+        ))
+    box = span_box(image.size, layout, monitor)
+    if not oversample:
+        size = (round(box[2] - box[0]), round(box[3] - box[1]))
+    image = image.resize(size, PIL.Image.LANCZOS, box=box, reducing_gap=2.0)
+    # Blur by the same amount on every monitor.
+    layout_pixels = max(layout) * image.width / width
+    image = blur_image(image, blurriness * layout_pixels / max(image.size))
+    image = grey_dim_image(image, greyness, dimness)
+    image.save(out_path, quality=EDIT_QUALITY)
+
+
+def compose_outputs(paths, monitors, out_path):
+    """Combine renders of each monitor into one spanned image."""
+    import PIL.Image
+    (height, width) = layout_size(monitors)
+    spanned = PIL.Image.new("RGB", (width, height))
+    for (path, monitor) in zip(paths, monitors):
+        (monitor_height, monitor_width, top, left) = monitor
+        with PIL.Image.open(path) as image:
+            if image.size != (monitor_width, monitor_height):
+                image = image.resize((monitor_width, monitor_height))
+            spanned.paste(image, (left, top))
+    spanned.save(out_path, quality=EDIT_QUALITY)
 
 
 class Config:
@@ -539,22 +3529,36 @@ class Config:
     def __init__(self, data_dir):
         self.initial = {
             "tags": [],
-            "imageboard": "https://danbooru.donmai.us",
+            "blacklist": [],
+            "imageboard": ["https://danbooru.donmai.us"],
             "attempts": 1,
+            "hedge": 1,
+            "timeout": 30.0,
+            "repeat": 0.0,
             "scale": 0.0,
+            "resolution": "",
+            "oversample": 1.0,
             "keep": 1,
+            "cache": 500.0,
+            "edits": 100.0,
+            "connections": HTTP_POOL_SIZE,
+            "rate": RATE_LIMIT,
             "period": 0.0,
             "blur": 0.0,
             "grey": 0.0,
             "dim": 0.0,
         }
         self.path = os.path.join(data_dir, "config.json")
-        try:
-            self.options = read_json(self.path)
-        except FileNotFoundError:
-            LOGGER.info("Missing config")
-            self.options = self.initial
-            self.write()
+        self.store = state_store(data_dir)
+        # Options as they were last read or written.
+        self.saved = None
+        with self.store.locked():
+            try:
+                self.read()
+            except FileNotFoundError:
+                LOGGER.info("Missing config")
+                self.options = dict(self.initial)
+                self.write()
 
     def __getitem__(self, key):
         return self.options[key]
@@ -571,24 +3575,43 @@ class Config:
     def __repr__(self):
         return repr(self.options)
 
+    def read(self):
+        """Read the JSON config from its path."""
+        # Options added since the config was written keep their initial
+        # values.
+        self.options = {**self.initial, **self.store.read(self.path)}
+        # Only one imageboard used to be supported.
+        if isinstance(self.options["imageboard"], str):
+            self.options["imageboard"] = [self.options["imageboard"]]
+        self.saved = json.dumps(self.options)
+
     def write(self):
-        """Write the JSON config to its path."""
-        write_json(self.path, self.options)
+        """Write the JSON config to its path, if it has changed."""
+        options = json.dumps(self.options)
+        if options == self.saved:
+            return
+        self.store.write(self.path, self.options)
+        self.saved = options
 
     def update(self, args):
         """Update the config options if they've changed."""
-        for option in self:
-            if args[option] is not None:
-                self[option] = args[option]
-        self.write()
+        # Read again, so changes made by others since aren't lost.
+        with self.store.transaction():
+            self.read()
+            for option in self:
+                if args[option] is not None:
+                    self[option] = args[option]
+            self.write()
 
     def reset(self, args):
         """Restore config options to their initial values."""
         none_specified = not any(args[option] for option in self)
-        for option in self:
-            if args[option] or none_specified:
-                self[option] = self.initial[option]
-        self.write()
+        with self.store.transaction():
+            self.read()
+            for option in self:
+                if args[option] or none_specified:
+                    self[option] = self.initial[option]
+            self.write()
 
     def format(self, args):
         """Return nicely formatted requested options."""
@@ -604,26 +3627,316 @@ class Config:
         return "\n".join(options)
 
 
-def edit_booru_wallpaper(config, path, edits_dir):
+def edited_image_path(path, edits_dir, edits, screen, oversample):
+    """Return where an edit of an image with the given settings is kept.
+
+    The name depends on everything that affects the result, so an edit
+    can be reused instead of made again.
+    """
+    (source, extension) = os.path.splitext(os.path.basename(path))
+    settings = [source, edits, screen, oversample, EDIT_QUALITY]
+    key = hashlib.md5(json.dumps(settings).encode()).hexdigest()
+    return os.path.join(edits_dir, f"{key}{extension}")
+
+
+def output_image_paths(path, edits_dir, edits, monitors, oversample):
+    """Return where the render of an image for each monitor is kept."""
+    layout = layout_size(monitors)
+    return [
+        edited_image_path(path, edits_dir, edits, [layout, monitor],
+                          oversample)
+        for monitor in monitors
+    ]
+
+
+def trim_edits(config, edits_dir, kept):
+    """Mark edits as used and evict others past the edits size limit."""
+    edits = FileCache(edits_dir)
+    for path in kept:
+        edits.use(path)
+    edits.evict(max_bytes=config["edits"] * 1024 * 1024, keep=kept)
+
+
+def config_edits(config):
+    """Return the blurriness, greyness and dimness to edit with."""
+    return (config["blur"] or 0, config["grey"] or 0, config["dim"] or 0)
+
+
+def edit_booru_wallpaper(config, path, edits_dir, screen=None, timings=None):
     """Modify the wallpaper in place and return its new path."""
-    blur = config["blur"] or 0
-    grey = config["grey"] or 0
-    dim = config["dim"] or 0
-    filename = os.path.basename(path)
-    new_path = os.path.join(edits_dir, filename)
-    print("Editing wallpaper...")
-    edit_image(path, new_path, blur, grey, dim)
+    (blur, grey, dim) = config_edits(config)
+    new_path = edited_image_path(
+        path, edits_dir, (blur, grey, dim), screen, config["oversample"]
+    )
+    if os.path.exists(new_path):
+        print("Using cached edit.")
+    else:
+        print("Editing wallpaper...")
+        edit_image(
+            path, new_path, blur, grey, dim, screen=screen,
+            oversample=config["oversample"], timings=timings
+        )
+    trim_edits(config, edits_dir, (new_path,))
     return new_path
 
 
-def update_and_edit(config, image_data_path, wallpapers_dir, edits_dir, args):
+def render_booru_outputs(config, path, edits_dir, monitors, spanned=True,
+                         timings=None):
+    """Render the wallpaper for each monitor, and return their paths.
+
+    Each monitor's part is rendered in a separate process at the same
+    time, so extra monitors add little to how long it takes.
+
+    Args:
+        spanned (bool): Whether to also combine the renders into one
+            image spanning every monitor. Defaults to True.
+        timings (dict): Where to record the seconds spent combining.
+            Defaults to None.
+
+    Returns:
+        (str, [str]): The path of the spanned image, or None if not
+            `spanned`, and the path of each monitor's render.
+    """
+    edits = config_edits(config)
+    oversample = config["oversample"]
+    layout = layout_size(monitors)
+    paths = output_image_paths(path, edits_dir, edits, monitors, oversample)
+    missing = [
+        (out_path, monitor) for (out_path, monitor) in zip(paths, monitors)
+        if not os.path.exists(out_path)
+    ]
+    if missing:
+        print("Rendering wallpaper for each monitor...")
+        renders = [
+            process_pool().submit(
+                render_output, path, out_path, layout, monitor, *edits,
+                oversample=oversample
+            )
+            for (out_path, monitor) in missing
+        ]
+        for render in renders:
+            render.result()
+    else:
+        print("Using cached renders.")
+    span_path = None
+    if spanned:
+        span_path = edited_image_path(
+            path, edits_dir, edits, monitors, oversample
+        )
+        if not os.path.exists(span_path):
+            with timed(timings, "compose"):
+                compose_outputs(paths, monitors, span_path)
+    trim_edits(config, edits_dir, paths + [span_path] if spanned else paths)
+    return (span_path, paths)
+
+
+def render_wallpaper(config, path, edits_dir, monitors, timings=None):
+    """Edit the wallpaper, or render it for each monitor if there are more.
+
+    Returns:
+        (str, [str]): The path of the image to set, or None if it's
+            `path` unchanged, and the path of each monitor's render, or
+            None if there's only one monitor.
+    """
+    if len(monitors) > 1:
+        return render_booru_outputs(
+            config, path, edits_dir, monitors,
+            spanned=not sets_per_output(), timings=timings
+        )
+    if all(config[edit] == 0 for edit in ("blur", "grey", "dim")):
+        return (None, None)
+    edited = edit_booru_wallpaper(
+        config, path, edits_dir, screen=layout_size(monitors),
+        timings=timings
+    )
+    return (edited, None)
+
+
+def render_image(path, edits_dir, edits, monitors, oversample=1.0,
+                 spanned=True):
+    """Make every edit of an image needed to set it, unless already made.
+
+    Meant to be run in a worker process, one image per process. The
+    edits are named as edit_booru_wallpaper and render_booru_outputs
+    name them, so they're reused when the image is next set.
+
+    Args:
+        path (str): Location of the original image.
+        edits_dir (str): Where the edits are kept.
+        edits ((float, float, float)): Blurriness, greyness and dimness.
+        monitors ([(int, int, int, int)]): Geometry of each monitor.
+        oversample (float): Ratio of the edit size relative to the
+            screen. Defaults to 1.0.
+        spanned (bool): Whether to also make an image spanning every
+            monitor, if there are several. Defaults to True.
+
+    Returns:
+        [str]: The paths of the edits.
+    """
+    if len(monitors) == 1:
+        screen = layout_size(monitors)
+        out_path = edited_image_path(
+            path, edits_dir, edits, screen, oversample
+        )
+        if not os.path.exists(out_path):
+            edit_image(
+                path, out_path, *edits, screen=screen, oversample=oversample
+            )
+        return [out_path]
+    layout = layout_size(monitors)
+    paths = output_image_paths(path, edits_dir, edits, monitors, oversample)
+    for (out_path, monitor) in zip(paths, monitors):
+        if not os.path.exists(out_path):
+            render_output(
+                path, out_path, layout, monitor, *edits,
+                oversample=oversample
+            )
+    if spanned:
+        span_path = edited_image_path(
+            path, edits_dir, edits, monitors, oversample
+        )
+        if not os.path.exists(span_path):
+            compose_outputs(paths, monitors, span_path)
+        paths.append(span_path)
+    return paths
+
+
+def run_batch(function, jobs):
+    """Call a function with each job's arguments in the process pool.
+
+    Only a couple of jobs per core are submitted at a time, so memory
+    stays bounded however many jobs there are.
+
+    Args:
+        function (callable): Module-level function to call.
+        jobs (iterable): Tuples of arguments to call it with.
+
+    Yields:
+        concurrent.futures.Future: Each job, once it's finished.
+    """
+    pool = process_pool()
+    limit = 2 * (os.cpu_count() or 1)
+    pending = set()
+    for args in jobs:
+        if len(pending) >= limit:
+            (done, pending) = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            yield from done
+        pending.add(pool.submit(function, *args))
+    yield from concurrent.futures.as_completed(pending)
+
+
+def cached_renditions(index, cache_dir):
+    """Return the cached images of the posts shown, by wallpaper filename.
+
+    Edits are named after the cached image they were made from, so
+    using it instead of the wallpaper lets their edits be shared.
+    Wallpapers are named after the link of the rendition they are, so
+    they're matched to every rendition of the posts in `index`.
+    """
+    paths = {}
+    for data in index.shown_posts():
+        for (variant, (url_field, _, _)) in IMAGE_VARIANTS.items():
+            if not data.get(url_field):
+                continue
+            path = cached_image_path(data, cache_dir, variant)
+            if os.path.exists(path):
+                url_path = urllib.parse.urlparse(data[url_field]).path
+                paths[os.path.basename(url_path)] = path
+    return paths
+
+
+def reedit_wallpapers(config, image_data_path, wallpapers_dir, edits_dir,
+                      cache_dir, everything=False):
+    """Edit wallpapers with the current settings, and set the current one.
+
+    Images are edited in parallel, one per process, and how many were
+    edited per second is reported.
+
+    Args:
+        everything (bool): Whether to edit every wallpaper kept in
+            `wallpapers_dir`, not just the current one. Defaults to
+            False.
+    """
+    data_dir = os.path.dirname(image_data_path)
+    screen_path = os.path.join(data_dir, "screen.json")
+    monitors = monitor_geometries(config["resolution"], screen_path)
+    edits = config_edits(config)
+    if len(monitors) == 1 and not any(edits):
+        print("There are no edits to make.")
+        return
+    try:
+        image_data = config.store.read(image_data_path)
+    except FileNotFoundError:
+        image_data = None
+    current = None
+    if image_data is not None:
+        current = original_image_path(image_data, wallpapers_dir, cache_dir)
+    paths = {current} if current is not None else set()
+    if everything:
+        index = PostIndex(os.path.join(data_dir, "posts.sqlite3"))
+        cached = cached_renditions(index, cache_dir)
+        for filename in os.listdir(wallpapers_dir):
+            if not filename.startswith("."):
+                path = os.path.join(wallpapers_dir, filename)
+                paths.add(cached.get(filename, path))
+    spanned = not sets_per_output()
+    jobs = [
+        (path, edits_dir, edits, monitors, config["oversample"], spanned)
+        for path in sorted(paths)
+    ]
+    print(f"Editing {len(jobs)} wallpapers...")
+    start = time.perf_counter()
+    edited = []
+    failures = 0
+    for job in run_batch(render_image, jobs):
+        try:
+            edited.extend(job.result())
+        except (OSError, ValueError) as ex:
+            LOGGER.warning(f"Could not edit a wallpaper: {ex}")
+            failures += 1
+    seconds = time.perf_counter() - start
+    done = len(jobs) - failures
+    print(
+        f"Edited {done} wallpapers in {seconds:.1f}s "
+        f"({done / (seconds or 1):.1f} images/s)."
+    )
+    log_event(
+        "reedit", images=done, failures=failures, seconds=seconds,
+        workers=os.cpu_count()
+    )
+    trim_edits(config, edits_dir, edited)
+    if current is not None:
+        (edited_path, outputs) = render_wallpaper(
+            config, current, edits_dir, monitors
+        )
+        set_wallpaper(edited_path or current, outputs)
+
+
+def update_and_edit(config, image_data_path, wallpapers_dir, edits_dir,
+                    cache_dir, args):
     """Update the config and edit the wallpaper if necessary."""
-    config.update(args)
+    with config.store.transaction():
+        config.update(args)
+        try:
+            image_data = config.store.read(image_data_path)
+        except FileNotFoundError:
+            image_data = None
     if any(args[edit] is not None for edit in ("blur", "grey", "dim")):
-        image_data = read_json(image_data_path)
-        image_path = booru_image_path(image_data, wallpapers_dir)
-        new_path = edit_booru_wallpaper(args, image_path, edits_dir)
-        set_wallpaper(new_path)
+        data_dir = os.path.dirname(image_data_path)
+        screen_path = os.path.join(data_dir, "screen.json")
+        if image_data is None:
+            # No wallpaper to edit yet, so the edits apply to the next.
+            return
+        monitors = monitor_geometries(config["resolution"], screen_path)
+        image_path = original_image_path(
+            image_data, wallpapers_dir, cache_dir
+        )
+        (edited, outputs) = render_wallpaper(
+            config, image_path, edits_dir, monitors
+        )
+        set_wallpaper(edited or image_path, outputs)
 
 
 def main(argv=None):
@@ -641,37 +3954,85 @@ def main(argv=None):
     image_data_path = os.path.join(data_dir, "image_data.json")
     wallpapers_dir = os.path.join(ROOT_DIR, "wallpapers")
     edits_dir = os.path.join(ROOT_DIR, "edits")
-    makedirs((data_dir, wallpapers_dir, edits_dir))
-    config = Config(data_dir)
-
-    if args["verbose"]:
-        _TERMINAL_HANDLER.setLevel(logging.DEBUG)
-    else:
-        _TERMINAL_HANDLER.setLevel(logging.INFO)
+    cache_dir = os.path.join(ROOT_DIR, "cache")
+    subcommand = args["subcommand"]
+    logged = subcommand in LOGGED_SUBCOMMANDS
+    init_logging(args["verbose"], logged)
     # No debug messages are displayed until the level is set, so no logs
     # can be performed until now.
     LOGGER.debug(f"args = {args}")
-    LOGGER.debug(f"config = {config}")
 
-    no_args = (len(sys.argv) == 1)
+    no_args = (subcommand is None)
     if no_args:
         argparser.print_help()
         sys.exit(2)
 
+    if subcommand in ("set", "next", "daemon", "reedit"):
+        makedirs((data_dir, wallpapers_dir, edits_dir, cache_dir))
+    else:
+        makedirs((data_dir,))
+    if logged:
+        init_event_log(os.path.join(data_dir, "events.jsonl"))
+    config = Config(data_dir)
+    LOGGER.debug(f"config = {config}")
+
+    if args["profile"]:
+        profile_path = os.path.join(data_dir, "profile.pstats")
+        # Downloads and edits would otherwise happen out of sight of the
+        # profiler, at the cost of attempts no longer overlapping.
+        run_inline()
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(
+                run_subcommand, args, config, image_data_path, wallpapers_dir,
+                edits_dir, cache_dir
+            )
+        finally:
+            profiler.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}")
+    else:
+        run_subcommand(
+            args, config, image_data_path, wallpapers_dir, edits_dir,
+            cache_dir
+        )
+
+
+def run_subcommand(args, config, image_data_path, wallpapers_dir, edits_dir,
+                   cache_dir):
+    """Do what the subcommand in the arguments asks for."""
     subcommand = args["subcommand"]
     if subcommand == "set":
         update_and_edit(
             config, image_data_path, wallpapers_dir, edits_dir,
-            args
+            cache_dir, args
         )
     if subcommand == "get":
         print(config.format(args))
     if subcommand == "reset":
         config.reset(args)
     if subcommand == "next":
-        next_wallpaper(config, image_data_path, wallpapers_dir, edits_dir)
+        next_wallpaper(
+            config, image_data_path, wallpapers_dir, edits_dir, cache_dir,
+            local=args["local"]
+        )
+    if subcommand == "reedit":
+        reedit_wallpapers(
+            config, image_data_path, wallpapers_dir, edits_dir, cache_dir,
+            everything=args["all"]
+        )
+    if subcommand == "daemon":
+        run_daemon(
+            config, image_data_path, wallpapers_dir, edits_dir, cache_dir
+        )
     if subcommand == "info":
-        print(wallpaper_info(image_data_path))
+        data_dir = os.path.dirname(image_data_path)
+        events_path = os.path.join(data_dir, "events.jsonl")
+        if args["timings"]:
+            print(format_timings(read_events(events_path, "wallpaper")))
+        elif args["events"]:
+            print(format_events(read_events(events_path)))
+        else:
+            print(wallpaper_info(image_data_path))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Benchmark: how long each stage of getting a wallpaper takes.
+
+Runs against a local mock imageboard (see mock_booru.py) in a scratch
+directory, so the real configuration and wallpaper are left alone.
+Results are written as JSON, so runs can be compared across versions.
+"""
+import sys
+import os
+import os.path
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import mock_booru
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+STAGES = ("import", "screen", "metadata", "download", "edit", "next")
+PERCENTILES = (50, 95, 99)
+# Modules that XD should only import when a subcommand needs them.
+LAZY_MODULES = ("asyncio", "email.utils", "tkinter", "requests", "PIL.Image")
+
+
+def percentile(samples, percent):
+    """Return the nearest-rank percentile of a sorted list of samples."""
+    rank = max(1, round(percent / 100 * len(samples)))
+    return samples[rank - 1]
+
+
+def summarise(samples, failures):
+    """Return statistics about the seconds a stage took."""
+    samples = sorted(samples)
+    summary = {"runs": len(samples), "failures": failures}
+    if samples:
+        summary["mean"] = sum(samples) / len(samples)
+        for percent in PERCENTILES:
+            summary[f"p{percent}"] = percentile(samples, percent)
+    return summary
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    """Call a function and record how long it took, or that it failed."""
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    except (Exception, SystemExit) as ex:
+        print(f"{stage} failed: {ex!r}", file=sys.stderr)
+        timings[stage]["failures"] += 1
+        return None
+    timings[stage]["samples"].append(time.perf_counter() - start)
+    return result
+
+
+def import_time():
+    """Return the seconds importing XD took and the modules it imported.
+
+    XD is imported in a fresh interpreter with `-X importtime`, which
+    reports the cumulative microseconds of every module imported.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import XD"],
+        cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    ).stderr
+    seconds = None
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        (_, cumulative, name) = line.split("|")
+        if not cumulative.strip().isdigit():
+            # The header.
+            continue
+        name = name.strip()
+        modules.append(name)
+        if name == "XD":
+            seconds = int(cumulative) / 1000000
+    return (seconds, modules)
+
+
+def time_imports(timings, iterations):
+    """Time importing XD, and return the lazy modules it imported."""
+    # The first import may have to compile XD.
+    import_time()
+    imported = set()
+    for _ in range(iterations):
+        (seconds, modules) = import_time()
+        timings["import"]["samples"].append(seconds)
+        imported.update(module for module in modules if module in LAZY_MODULES)
+    return sorted(imported)
+
+
+def git_version():
+    """Return the commit being benchmarked, if known."""
+    try:
+        output = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout
+    except OSError:
+        return None
+    return output.strip() or None
+
+
+def run(args):
+    """Benchmark every stage and return the results."""
+    root_dir = tempfile.mkdtemp(prefix="booru-benchmark-")
+    # XD decides where to keep everything when it is imported.
+    os.environ["XD_ROOT"] = root_dir
+    sys.path.insert(0, REPO_DIR)
+    import XD
+
+    if not args["set_wallpaper"]:
+        XD.set_wallpaper = lambda path, outputs=None: None
+    server = mock_booru.serve(**mock_booru.server_options(args))
+    edits = {"blur": args["blur"], "grey": args["grey"], "dim": args["dim"]}
+    XD.main([
+        "set", "-i", server.url, "-t", *args["tags"],
+        "-r", args["resolution"], "-s", str(args["scale"]),
+        *(f"--{edit}={value}" for (edit, value) in edits.items()),
+    ])
+    config = XD.Config(os.path.join(root_dir, "data"))
+    scratch_dir = os.path.join(root_dir, "scratch")
+    os.makedirs(scratch_dir, exist_ok=True)
+    timings = {stage: {"samples": [], "failures": 0} for stage in STAGES}
+    print("Timing imports")
+    eager_imports = time_imports(timings, args["iterations"])
+    for iteration in range(args["iterations"]):
+        print(f"Iteration {iteration + 1}/{args['iterations']}")
+        XD.init_http_session(config["connections"])
+        screen = timed(
+            timings, "screen", XD.screen_dimensions, config["resolution"]
+        )
+        data = timed(
+            timings, "metadata", XD.get_image_data, config["tags"],
+            config["imageboard"], attempts=config["attempts"],
+            scale=config["scale"], screen=screen
+        )
+        if data is not None:
+            backend = XD.imageboard_backend(data["imageboard"])
+            variant = XD.image_variants(data, screen, config["oversample"])[0]
+            url = backend.file_url(data, variant)
+            path = os.path.join(scratch_dir, os.path.basename(url))
+            timed(timings, "download", XD.download, url, path)
+            out_path = os.path.join(scratch_dir, f"edit-{iteration}.jpg")
+            if os.path.exists(path):
+                timed(
+                    timings, "edit", XD.edit_image, path, out_path,
+                    args["blur"], args["grey"], args["dim"], screen=screen,
+                    oversample=config["oversample"]
+                )
+                os.remove(path)
+            if os.path.exists(out_path):
+                os.remove(out_path)
+        timed(timings, "next", XD.main, ["next"])
+    server.shutdown()
+    shutil.rmtree(root_dir, ignore_errors=True)
+    return {
+        "version": git_version(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": args,
+        "requests": server.hits,
+        "eager_imports": eager_imports,
+        "stages": {
+            stage: summarise(timing["samples"], timing["failures"])
+            for (stage, timing) in timings.items()
+        },
+    }
+
+
+def format_results(results):
+    """Return a table of the percentiles of each stage, in milliseconds."""
+    columns = ("mean",) + tuple(f"p{percent}" for percent in PERCENTILES)
+    lines = ["stage     " + "".join(f"{column:>10}" for column in columns)]
+    for (stage, summary) in results["stages"].items():
+        cells = "".join(
+            f"{summary[column] * 1000:>10.1f}" if column in summary
+            else f"{'-':>10}"
+            for column in columns
+        )
+        lines.append(f"{stage:<10}{cells}  ({summary['failures']} failed)")
+    for module in results["eager_imports"]:
+        lines.append(f"{module} is imported with XD, but shouldn't be")
+    return "\n".join(lines)
+
+
+def over_budget(results, import_budget):
+    """Return whether importing XD was slower than the budget.
+
+    Args:
+        results (dict): Results of run.
+        import_budget (float): Most milliseconds the median import may
+            take. Modules in LAZY_MODULES being imported with XD also
+            counts as going over.
+    """
+    median = results["stages"]["import"].get("p50")
+    if results["eager_imports"]:
+        return True
+    return median is not None and median * 1000 > import_budget
+
+
+def init_argparser():
+    """Return an ArgumentParser specialised for this script."""
+    argparser = argparse.ArgumentParser(
+        description="Time each stage of getting a wallpaper against a mock "
+        "imageboard",
+    )
+    argparser.add_argument(
+        "-n", "--iterations", type=int, default=10,
+        help="number of times to run each stage"
+    )
+    argparser.add_argument(
+        "-o", "--output", help="file to write the results to as JSON"
+    )
+    argparser.add_argument(
+        "-t", "--tags", nargs="*", default=[],
+        help="labels to search for"
+    )
+    argparser.add_argument(
+        "-r", "--resolution", default="1920x1080",
+        help="screen size to pretend to have (an empty value means it will "
+        "be detected)"
+    )
+    argparser.add_argument(
+        "-s", "--scale", type=float, default=0.0,
+        help="minimum image size ratio relative to the screen"
+    )
+    for edit in ("blur", "grey", "dim"):
+        argparser.add_argument(
+            f"--{edit}", type=float, default=0.0,
+            help=f"percentage of {edit} to edit with"
+        )
+    argparser.add_argument(
+        "--import-budget", type=float, default=100.0,
+        help="most milliseconds importing XD may take at the median before "
+        "the benchmark fails"
+    )
+    argparser.add_argument(
+        "--set-wallpaper", action="store_true",
+        help="really set the wallpaper"
+    )
+    mock_booru.add_options(argparser)
+    return argparser
+
+
+def main(argv=None):
+    """Run the benchmark and print and store its results."""
+    args = vars(init_argparser().parse_args(argv))
+    results = run(args)
+    print(format_results(results))
+    if args["output"] is not None:
+        with open(args["output"], "w") as file:
+            json.dump(results, file, indent=4)
+    if over_budget(results, args["import_budget"]):
+        print(
+            f"Importing XD is over the budget of {args['import_budget']}ms.",
+            file=sys.stderr
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""Stand-in for a Danbooru-like imageboard, for benchmarks offline.
+
+Serves random posts from /posts.json, single posts from /posts/ID.json
+and their images, with configurable latency, bandwidth and failures.
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import io
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+import PIL.Image
+
+# Image sizes posts are given, as width and height.
+SIZES = ((1280, 720), (1920, 1080), (2560, 1440), (3840, 2160), (1200, 1800))
+# File types posts are given, mostly images as on Danbooru.
+FILE_EXTENSIONS = ("jpg",) * 6 + ("png", "gif", "mp4", "webm")
+# Tags posts are given, by category.
+TAGS = {
+    "artist": ("zun", "ke-ta", "shnva"),
+    "character": ("hakurei_reimu", "kirisame_marisa", "cirno"),
+    "copyright": ("touhou", "vocaloid", "original"),
+    "general": ("scenery", "sky", "rain", "night", "1girl", "landscape"),
+}
+# Width of sample images, as on Danbooru.
+SAMPLE_WIDTH = 850
+# Width of preview images.
+PREVIEW_WIDTH = 150
+
+
+def shrunk(width, height, target):
+    """Return an image size shrunk to a width, if it's wider."""
+    if target < width:
+        return (target, max(1, height * target // width))
+    return (width, height)
+
+
+def make_posts(count, seed=0):
+    """Return a dict of random posts by ID, in the shape Danbooru uses."""
+    rng = random.Random(seed)
+    posts = {}
+    for post_id in range(1, count + 1):
+        (width, height) = rng.choice(SIZES)
+        md5 = hashlib.md5(f"post {post_id}".encode()).hexdigest()
+        extension = rng.choice(FILE_EXTENSIONS)
+        post = {
+            "id": post_id,
+            "md5": md5,
+            "file_ext": extension,
+            "image_width": width,
+            "image_height": height,
+            "rating": rng.choice("sqe"),
+            "file_url": f"/data/{md5}.{extension}",
+            "large_file_url": f"/data/sample/sample-{md5}.jpg",
+            "preview_file_url": f"/data/preview/{md5}.jpg",
+            "file_size": len(render(width, height)),
+        }
+        variants = []
+        for (kind, field, target) in (
+                ("sample", "large_file_url", SAMPLE_WIDTH),
+                ("180x180", "preview_file_url", PREVIEW_WIDTH)):
+            (variant_width, variant_height) = shrunk(width, height, target)
+            variants.append({
+                "type": kind, "url": post[field], "width": variant_width,
+                "height": variant_height,
+            })
+        post["media_asset"] = {"variants": variants}
+        tags = []
+        for (category, names) in TAGS.items():
+            chosen = rng.sample(names, rng.randint(1, 2))
+            post[f"tag_string_{category}"] = " ".join(chosen)
+            tags.extend(chosen)
+        post["tag_string"] = " ".join(sorted(tags))
+        posts[post_id] = post
+    return posts
+
+
+def matches_size(value, condition):
+    """Return whether a number meets a condition like ">=1920"."""
+    for operator in (">=", "<=", ">", "<"):
+        if condition.startswith(operator):
+            bound = int(condition[len(operator):])
+            return {
+                ">=": value >= bound, "<=": value <= bound,
+                ">": value > bound, "<": value < bound,
+            }[operator]
+    return value == int(condition)
+
+
+def matches(post, tags):
+    """Return whether a post matches a Danbooru-like tag search."""
+    post_tags = set(post["tag_string"].split())
+    for tag in tags:
+        if tag.startswith("rating:"):
+            if post["rating"] != tag[len("rating:"):][:1]:
+                return False
+        elif tag.startswith("filetype:"):
+            if post["file_ext"] not in tag[len("filetype:"):].split(","):
+                return False
+        elif tag.startswith(("width:", "height:")):
+            (name, condition) = tag.split(":", 1)
+            if not matches_size(post[f"image_{name}"], condition):
+                return False
+        elif tag.startswith("-"):
+            if tag[1:] in post_tags:
+                return False
+        elif ":" in tag:
+            # Other metatags aren't understood, so they're ignored.
+            continue
+        elif tag not in post_tags:
+            return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def noise_tile(size=256):
+    """Return a square of colourful noise."""
+    bands = [PIL.Image.effect_noise((size, size), 48) for _ in range(3)]
+    return PIL.Image.merge("RGB", bands)
+
+
+@functools.lru_cache(maxsize=64)
+def render(width, height):
+    """Return the bytes of a noisy JPEG, which compresses like a photo."""
+    image = PIL.Image.new("RGB", (width, height))
+    tile = noise_tile()
+    # Faster than making noise the size of the whole image.
+    for x in range(0, width, tile.width):
+        for y in range(0, height, tile.height):
+            image.paste(tile, (x, y))
+    file = io.BytesIO()
+    image.save(file, "JPEG", quality=90)
+    return file.getvalue()
+
+
+class MockBooru(http.server.ThreadingHTTPServer):
+
+    """HTTP server acting like a Danbooru-like imageboard."""
+
+    daemon_threads = True
+
+    def __init__(self, address, posts, latency=0.0, bandwidth=0,
+                 error_rate=0.0, throttle_rate=0.0, empty_rate=0.0,
+                 tag_limit=2, seed=None):
+        super().__init__(address, MockBooruHandler)
+        self.posts = posts
+        self.by_md5 = {post["md5"]: post for post in posts.values()}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.empty_rate = empty_rate
+        self.tag_limit = tag_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    @property
+    def url(self):
+        """Return the base URL of the server."""
+        (host, port) = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def roll(self, rate):
+        """Return True with probability `rate`."""
+        with self.lock:
+            return self.rng.random() < rate
+
+
+class MockBooruHandler(http.server.BaseHTTPRequestHandler):
+
+    """Request handler for MockBooru."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200, content_type="application/json",
+                  headers=None):
+        """Send a response, throttled to the server's bandwidth."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # Send a tenth of a second's worth at a time.
+        chunk_size = max(1, bandwidth // 10)
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start:start + chunk_size])
+            time.sleep(0.1)
+
+    def send_json(self, data, status=200, headers=None):
+        """Send a JSON response."""
+        body = json.dumps(data).encode()
+        self.send_body(body, status, headers=headers)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits += 1
+        if server.latency:
+            time.sleep(server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if server.roll(server.throttle_rate):
+            self.send_json(
+                {"success": False, "message": "Throttled"}, status=429,
+                headers={"Retry-After": "1"}
+            )
+        elif server.roll(server.error_rate):
+            self.send_json(
+                {"success": False, "message": "Internal error"}, status=500
+            )
+        elif url.path == "/posts.json":
+            self.send_posts(query)
+        elif url.path == "/tags.json":
+            self.send_tags(query)
+        elif url.path.startswith("/posts/"):
+            self.send_post(url.path[len("/posts/"):])
+        elif url.path.startswith("/data/"):
+            self.send_image(url.path)
+        else:
+            self.send_json({"success": False, "message": "Not found"}, 404)
+
+    def send_posts(self, query):
+        """Send a page of posts matching the search."""
+        server = self.server
+        limit = int(query.get("limit", ["20"])[0])
+        tags = query.get("tags", [""])[0].split()
+        if server.tag_limit and len(tags) > server.tag_limit:
+            message = (
+                f"You cannot search for more than {server.tag_limit} tags "
+                "at a time"
+            )
+            self.send_json({"success": False, "message": message}, 422)
+            return
+        if server.roll(server.empty_rate):
+            self.send_json([])
+            return
+        found = [
+            post for post in server.posts.values() if matches(post, tags)
+        ]
+        if query.get("random", ["false"])[0] == "true":
+            with server.lock:
+                server.rng.shuffle(found)
+        self.send_json(found[:limit])
+
+    def send_tags(self, query):
+        """Send the post counts of the tags named in the search."""
+        names = query.get("search[name_comma]", [""])[0].split(",")
+        tags = []
+        for name in filter(None, names):
+            count = sum(
+                name in post["tag_string"].split()
+                for post in self.server.posts.values()
+            )
+            if count:
+                tags.append({"name": name, "post_count": count})
+        self.send_json(tags)
+
+    def send_post(self, name):
+        """Send a single post."""
+        post_id = name[:-len(".json")] if name.endswith(".json") else name
+        try:
+            post = self.server.posts[int(post_id)]
+        except (ValueError, KeyError):
+            self.send_json({"success": False, "message": "Not found"}, 404)
+            return
+        self.send_json(post)
+
+    def send_image(self, path):
+        """Send an original, sample or preview image, allowing ranges."""
+        filename = path.rsplit("/", 1)[-1]
+        md5 = filename.rsplit(".", 1)[0].replace("sample-", "")
+        try:
+            post = self.server.by_md5[md5]
+        except KeyError:
+            self.send_json({"success": False, "message": "Not found"}, 404)
+            return
+        (width, height) = (post["image_width"], post["image_height"])
+        if path.startswith("/data/sample/"):
+            target = SAMPLE_WIDTH
+        elif path.startswith("/data/preview/"):
+            target = PREVIEW_WIDTH
+        else:
+            target = width
+        body = render(*shrunk(width, height, target))
+        ranged = self.headers.get("Range", "")
+        if ranged.startswith("bytes="):
+            start = int(ranged[len("bytes="):].split("-")[0] or 0)
+            if start >= len(body):
+                self.send_body(b"", status=416, content_type="image/jpeg")
+                return
+            headers = {
+                "Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}",
+            }
+            self.send_body(body[start:], 206, "image/jpeg", headers)
+            return
+        self.send_body(body, content_type="image/jpeg")
+
+
+def make_server(port=0, posts=100, **kwargs):
+    """Return a MockBooru with made up posts.
+
+    Args:
+        port (int): Port to listen on. Defaults to 0, meaning any free
+            port.
+        posts (int): Number of posts to make up. Defaults to 100.
+        **kwargs: Passed on to MockBooru.
+    """
+    return MockBooru(("127.0.0.1", port), make_posts(posts), **kwargs)
+
+
+def serve(port=0, posts=100, **kwargs):
+    """Start a MockBooru in a background thread and return it.
+
+    Call the server's shutdown method to stop it. See make_server for
+    the arguments.
+    """
+    server = make_server(port, posts, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def init_argparser():
+    """Return an ArgumentParser specialised for this script."""
+    argparser = argparse.ArgumentParser(
+        description="Serve a stand-in Danbooru-like imageboard"
+    )
+    add_options(argparser)
+    argparser.add_argument(
+        "-p", "--port", type=int, default=8000, help="port to listen on"
+    )
+    return argparser
+
+
+def add_options(argparser):
+    """Add the options for the mock imageboard to an ArgumentParser."""
+    argparser.add_argument(
+        "--posts", type=int, default=100, help="number of posts to serve"
+    )
+    argparser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="seconds to wait before each response"
+    )
+    argparser.add_argument(
+        "--bandwidth", type=int, default=0,
+        help="bytes per second to send at (a value of 0 means unlimited)"
+    )
+    argparser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="fraction of requests that fail with status 500"
+    )
+    argparser.add_argument(
+        "--throttle-rate", type=float, default=0.0,
+        help="fraction of requests that fail with status 429"
+    )
+    argparser.add_argument(
+        "--empty-rate", type=float, default=0.0,
+        help="fraction of searches that find nothing"
+    )
+    argparser.add_argument(
+        "--tag-limit", type=int, default=2,
+        help="most tags a search may have (a value of 0 means no limit)"
+    )
+    argparser.add_argument(
+        "--seed", type=int, default=None, help="seed for random failures"
+    )
+
+
+def server_options(args):
+    """Return the keyword arguments for serve from parsed arguments."""
+    options = ("latency", "bandwidth", "error_rate", "throttle_rate",
+               "empty_rate", "tag_limit", "seed", "posts")
+    return {option: args[option] for option in options}
+
+
+def main(argv=None):
+    """Serve a mock imageboard until interrupted."""
+    args = vars(init_argparser().parse_args(argv))
+    server = make_server(args["port"], **server_options(args))
+    print(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,11 @@
 #!/usr/bin/env python3
 """Daemon: ability to the extent of changing wallpapers."""
-# XXX: just use nohup service.py &
-# XXX: just use nohup XD.py --next &
+# XXX: just use nohup XD.py daemon &
 import os
-import time
-import json
+import sys
 
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS_DIR))
 import XD
 
-with open(XD.config_path) as config_file:
-    config = json.load(config_file)
-
-while True:
-    time.sleep(config['duration'])
-    XD.main(['--next'])
+XD.main(["daemon"])